@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+
+from mtbrl.algorithms.bamdp import Policy
+
+
+def _sample(successors, random_state):
+    next_states, probabilities = successors
+    cdf = np.cumsum(probabilities)
+    return int(next_states[np.searchsorted(cdf, random_state.random_sample() * cdf[-1], side='right')])
+
+
+class BAMCPPolicy(Policy):
+    # Bayes-adaptive Monte Carlo planning (Guez et al., 2012). Each decision runs UCT on the history tree, sampling a
+    # model from the posterior at the root of every simulation. The search stops after n_simulations simulations or
+    # time_limit seconds, whichever comes first, and looks at most max_depth steps ahead. The exploration bonus is
+    # scaled by the range of returns over the steps searched.
+    def __init__(self, bamdp, initial_distribution, horizon, n_simulations=1000, time_limit=None, exploration=1.,
+                 max_depth=None, seed=None):
+        if n_simulations is None and time_limit is None:
+            raise ValueError('The search needs a number of simulations or a time limit.')
+
+        self.bamdp = bamdp
+        self.initial_distribution = initial_distribution
+        self.horizon = horizon
+        self.n_simulations = n_simulations
+        self.time_limit = time_limit
+        self.exploration = exploration
+        self.max_depth = max_depth
+        self.random_state = np.random.RandomState(seed)
+
+        self._policy = {}
+
+    def __getitem__(self, states):
+        if len(states) - 1 >= self.horizon:
+            raise IndexError(states)
+
+        if states not in self._policy:
+            actions = tuple([self[states[:t]] for t in range(1, len(states))])
+            self._policy[states] = self.search(states, actions)
+
+        return self._policy[states]
+
+    def search(self, states, actions):
+        depth = self.horizon - (len(states) - 1)
+        if self.max_depth is not None:
+            depth = min(depth, self.max_depth)
+
+        # Search tree statistics, indexed by node. The root is node 0.
+        self._visits = [0]
+        self._action_visits = [np.zeros(self.bamdp.n_actions)]
+        self._action_values = [np.zeros(self.bamdp.n_actions)]
+        self._children = {}
+
+        lower, upper = self.bamdp.value_bounds(depth)
+        self._scale = upper - lower
+
+        posterior = self.bamdp.posterior(self.initial_distribution, states, actions)
+
+        start = time.perf_counter()
+        simulations = 0
+        while self.n_simulations is None or simulations < self.n_simulations:
+            if self.time_limit is not None and time.perf_counter() - start > self.time_limit:
+                break
+
+            model = self.bamdp.sample_posterior(posterior, self.random_state)
+            self.simulate(model, states[-1], depth)
+            simulations += 1
+
+        return int(np.argmax(self._action_values[0]))
+
+    def simulate(self, model, state, depth):
+        path = []
+        node, value = 0, 0.
+        for t in range(depth):
+            action = self.select(node)
+            next_state = _sample(model.successors(state, action), self.random_state)
+            path.append((node, action, self.bamdp.reward[next_state]))
+            state = next_state
+
+            key = (node, action, next_state)
+            if key not in self._children:
+                self._children[key] = len(self._visits)
+                self._visits.append(0)
+                self._action_visits.append(np.zeros(self.bamdp.n_actions))
+                self._action_values.append(np.zeros(self.bamdp.n_actions))
+
+                value = self.rollout(model, state, depth - t - 1)
+                break
+
+            node = self._children[key]
+
+        for node, action, reward in reversed(path):
+            value = reward + self.bamdp.discount * value
+
+            self._visits[node] += 1
+            self._action_visits[node][action] += 1
+            self._action_values[node][action] += (value - self._action_values[node][action]) / self._action_visits[node][action]
+
+        return value
+
+    def select(self, node):
+        untried = np.flatnonzero(self._action_visits[node] == 0)
+        if len(untried) > 0:
+            return int(self.random_state.choice(untried))
+
+        bonus = np.sqrt(np.log(self._visits[node]) / self._action_visits[node])
+        return int(np.argmax(self._action_values[node] + self.exploration * self._scale * bonus))
+
+    def rollout(self, model, state, depth):
+        value, discount = 0., 1.
+        for _ in range(depth):
+            action = self.random_state.randint(self.bamdp.n_actions)
+            state = _sample(model.successors(state, action), self.random_state)
+
+            value += discount * self.bamdp.reward[state]
+            discount *= self.bamdp.discount
+
+        return value
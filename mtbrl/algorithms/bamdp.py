@@ -1,19 +1,133 @@
+import collections
+import functools
+import os
+import shutil
+import tempfile
+import time
+import weakref
+
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
 
+def _nonzero(probabilities):
+    states = np.flatnonzero(~np.isclose(probabilities, 0))
+    return states, probabilities[states]
+
+
+def _compress(rows, columns, values, n_rows, n_columns):
+    # Compressed sparse row representation of (row, column, value) triplets, summing duplicates and dropping zeros
+    keys, inverse = np.unique(np.asarray(rows, dtype=np.int64) * n_columns + columns, return_inverse=True)
+    values = np.bincount(inverse.reshape(-1), weights=values, minlength=len(keys))
+
+    nonzero = ~np.isclose(values, 0)
+    keys, values = keys[nonzero], values[nonzero]
+
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // n_columns, minlength=n_rows))])
+    return indptr, keys % n_columns, values
+
+
+def _expand_rows(indptr):
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+
+def _sampling_keys(indptr, probabilities):
+    # Inverse transform sampling: the cumulative probabilities of each row, offset by its index, are increasing across
+    # rows, so a single search for row + u, with u uniform in [0, 1), samples a successor of every row at once
+    rows = _expand_rows(indptr)
+    cdf = np.cumsum(probabilities)
+    row_start = np.concatenate([[0.], cdf])[indptr[:-1]]
+    row_total = np.concatenate([[0.], cdf])[indptr[1:]] - row_start
+    keys = rows + (cdf - row_start[rows]) / row_total[rows]
+    last = indptr[1:][np.diff(indptr) > 0] - 1
+    keys[last] = rows[last] + 1.
+
+    return keys
+
+
 class Policy:
     def __getitem__(self, states):
         raise NotImplementedError()
 
+    # Actions for a (n_episodes, n_steps) array of histories, one per row
+    def batch_actions(self, states):
+        histories, inverse = np.unique(states, axis=0, return_inverse=True)
+        actions = np.array([self[tuple(history)] for history in histories.tolist()], dtype=int)
+        return actions[inverse.reshape(-1)]
+
+    def cursor(self):
+        return PolicyCursor(self)
+
+
+class PolicyCursor:
+    # Follows a policy along a single history, one state at a time
+    def __init__(self, policy):
+        self.policy = policy
+        self.states = []
+
+    def reset(self, state):
+        self.states = [state]
+        return self.policy[tuple(self.states)]
+
+    def step(self, next_state):
+        self.states.append(next_state)
+        return self.policy[tuple(self.states)]
+
 
 class Model:
     def __init__(self, n_states, n_actions):
         self.n_states = n_states
         self.n_actions = n_actions
 
+        # Successors of each (s, a) with non-zero probability, set by compress
+        self.successor_indptr = None
+        self.successor_states = None
+        self.successor_probabilities = None
+
     def __call__(self, s, a, next_s):
         raise NotImplementedError()
 
+    def compress(self, p):
+        rows, next_states = np.nonzero(p.reshape(-1, self.n_states))
+        self.compress_transitions(rows // self.n_actions, rows % self.n_actions, next_states,
+                                  p.reshape(-1, self.n_states)[rows, next_states])
+
+    # Probabilities of repeated (s, a, next_s) triplets are summed
+    def compress_transitions(self, states, actions, next_states, probabilities):
+        rows = np.asarray(states, dtype=np.int64) * self.n_actions + actions
+        self.successor_indptr, self.successor_states, self.successor_probabilities = \
+            _compress(rows, next_states, probabilities, self.n_states * self.n_actions, self.n_states)
+
+    def sparse_transitions(self):
+        if self.successor_indptr is not None:
+            return self.successor_indptr, self.successor_states, self.successor_probabilities
+
+        p = self.transition_tensor().reshape(-1, self.n_states)
+        rows, next_states = np.nonzero(p)
+        return _compress(rows, next_states, p[rows, next_states], self.n_states * self.n_actions, self.n_states)
+
+    def transition_tensor(self):
+        p = np.zeros((self.n_states, self.n_actions, self.n_states))
+
+        if self.successor_indptr is None:
+            for s in range(self.n_states):
+                for a in range(self.n_actions):
+                    for next_s in range(self.n_states):
+                        p[s, a, next_s] = self(s, a, next_s)
+        else:
+            p.reshape(-1, self.n_states)[_expand_rows(self.successor_indptr), self.successor_states] = self.successor_probabilities
+
+        return p
+
+    def successors(self, s, a):
+        if self.successor_indptr is None:
+            return _nonzero(np.array([self(s, a, next_s) for next_s in range(self.n_states)]))
+
+        i = s * self.n_actions + a
+        start, end = self.successor_indptr[i], self.successor_indptr[i + 1]
+        return self.successor_states[start:end], self.successor_probabilities[start:end]
+
     def render(self, state, reward):
         raise NotImplementedError()
 
@@ -24,130 +138,1344 @@ class Model:
         if render:
             self.render(states[-1], reward[states[-1]])
 
+        cursor = policy.cursor()
         while True:
             try:
-                a = policy[tuple(states)]
+                a = cursor.reset(states[0]) if len(states) == 1 else cursor.step(states[-1])
             except LookupError:
                 break
 
-            probabilities = [self(states[-1], a, next_s) for next_s in range(self.n_states)]
-            states.append(random_state.choice(self.n_states, p=probabilities))
+            next_states, probabilities = self.successors(states[-1], a)
+            states.append(int(next_states[random_state.choice(len(next_states), p=probabilities)]))
 
             if render:
                 self.render(states[-1], reward[states[-1]])
 
         return states
 
+    def simulate_batch(self, initial_distribution, reward, policy, n_episodes, horizon, seed=None):
+        random_state = np.random.RandomState(seed)
+        indptr, next_states, probabilities = self.sparse_transitions()
+        keys = _sampling_keys(indptr, probabilities)
+
+        states = np.zeros((n_episodes, horizon + 1), dtype=int)
+
+        initial_cdf = np.cumsum(initial_distribution)
+        states[:, 0] = np.searchsorted(initial_cdf, random_state.random_sample(n_episodes) * initial_cdf[-1], side='right')
+
+        for t in range(horizon):
+            actions = policy.batch_actions(states[:, :t + 1])
+            row = states[:, t] * self.n_actions + actions
+            states[:, t + 1] = next_states[np.searchsorted(keys, row + random_state.random_sample(n_episodes), side='right')]
+
+        return states, np.asarray(reward)[states[:, 1:]]
+
 
 class OptimalPolicy(Policy):
-    def __init__(self, q_star):
+    # If cache_size is not None, only the actions for the cache_size most recently used histories are cached. If bamdp
+    # is not None, q_star is indexed by its hyperstates, whose beliefs are updated one step at a time from
+    # initial_distribution rather than recomputed from each history.
+    def __init__(self, q_star, hyperstate=None, cache_size=None, bamdp=None, initial_distribution=None):
         self.q_star = q_star
-        self._policy = {}
+        self.hyperstate = hyperstate
+        self.cache_size = cache_size
+        self.bamdp = bamdp
+        self.initial_distribution = initial_distribution
+        self._policy = collections.OrderedDict()
+        self._tree = None
 
     def __getitem__(self, states):
-        if states not in self._policy:
-            actions = tuple([self[states[:t]] for t in range(1, len(states))])
-            self._policy[states] = np.argmax(self.q_star[(states, actions)])
+        if states in self._policy:
+            if self.cache_size is not None:
+                self._policy.move_to_end(states)
+
+            return self._policy[states]
+
+        # The actions along the history are found from its shortest prefix onwards, each from the ones before it, so
+        # that a history costs at most one lookup per step whatever the cache keeps. A PolicyTree is followed one edge
+        # per step.
+        tree = self.q_star if isinstance(self.q_star, PolicyTree) else None
+        actions, belief, node = [], None, None
+        for t in range(1, len(states) + 1):
+            prefix = states[:t]
+            if tree is not None:
+                node = tree.node(prefix, ()) if t == 1 else tree.child(node, actions[-1], prefix[-1])
+                if node < 0:
+                    raise KeyError(prefix)
+            elif self.bamdp is not None:
+                belief = self.bamdp.initial_belief(self.initial_distribution, prefix[0]) if t == 1 else \
+                    self.bamdp.update_belief(belief, prefix[-2], actions[-1], prefix[-1])
+
+            if prefix in self._policy:
+                action = self._policy[prefix]
+                if self.cache_size is not None:
+                    self._policy.move_to_end(prefix)
+            else:
+                action = np.argmax(tree.q[node]) if tree is not None else self.action(prefix, tuple(actions), belief)
+                self._policy[prefix] = action
+                if self.cache_size is not None and len(self._policy) > self.cache_size:
+                    self._policy.popitem(last=False)
+
+            actions.append(action)
+
+        return actions[-1]
+
+    def action(self, states, actions, belief=None):
+        if self.bamdp is not None:
+            key = self.bamdp.hyperstate(self.initial_distribution, states, actions, belief)
+        elif self.hyperstate is not None:
+            key = self.hyperstate(states, actions)
+        else:
+            key = (states, actions)
+
+        return np.argmax(self.q_star[key])
+
+    # The action values as a PolicyTree, built from q_star on first use if it is a dict indexed by histories
+    def tree(self):
+        if isinstance(self.q_star, PolicyTree):
+            return self.q_star
+
+        if self._tree is None:
+            self._tree = PolicyTree.from_q_star(self.q_star)
+
+        return self._tree
+
+    # Action values in a PolicyTree are looked up for every history at once
+    def batch_actions(self, states):
+        if not isinstance(self.q_star, PolicyTree):
+            return Policy.batch_actions(self, states)
+
+        nodes = self.q_star.follow(states)
+        if np.any(nodes < 0):
+            raise KeyError(tuple(np.asarray(states)[np.argmax(nodes < 0)].tolist()))
+
+        return np.argmax(self.q_star.q[nodes], axis=1)
+
+    def cursor(self):
+        return OptimalPolicyCursor(self)
+
+
+class OptimalPolicyCursor(PolicyCursor):
+    # Keeps track of the actions taken, so that no earlier action is looked up again. Action values indexed by
+    # histories are followed through a PolicyTree, one edge per step. Action values indexed by hyperstates are looked up
+    # with a belief updated at each step, if the policy knows its BAMDP, so that a step costs as much as building a
+    # hyperstate: constant for a CountableBAMDP, and linear in the informative transitions seen for a DirichletBAMDP.
+    # A policy with a cache_size looks its dict up directly instead, so that it never holds a second copy of q_star.
+    def __init__(self, policy):
+        PolicyCursor.__init__(self, policy)
+        self.actions = []
+        self.node = None
+        self.belief = None
+
+        self._indexed = policy.hyperstate is None and policy.bamdp is None and \
+            (isinstance(policy.q_star, PolicyTree) or policy.cache_size is None)
+
+    def reset(self, state):
+        self.states, self.actions = [state], []
+
+        if self._indexed:
+            tree = self.policy.tree()
+            self.node = tree.node((state,), ())
+            self.actions.append(np.argmax(tree.q[self.node]))
+        else:
+            if self.policy.bamdp is not None:
+                self.belief = self.policy.bamdp.initial_belief(self.policy.initial_distribution, state)
+            self.actions.append(self.policy.action((state,), (), self.belief))
+
+        return self.actions[-1]
+
+    def step(self, next_state):
+        if self._indexed:
+            tree = self.policy.tree()
+            node = tree.child(self.node, self.actions[-1], next_state)
+            if node < 0:
+                raise KeyError(next_state)
+
+            self.node = node
+            self.states.append(next_state)
+            self.actions.append(np.argmax(tree.q[self.node]))
+        elif self.policy.bamdp is not None:
+            self.belief = self.policy.bamdp.update_belief(self.belief, self.states[-1], self.actions[-1], next_state)
+            self.states.append(next_state)
+            self.actions.append(self.policy.action(self.states, self.actions, self.belief))
+        else:
+            self.states.append(next_state)
+            self.actions.append(self.policy.action(tuple(self.states), tuple(self.actions)))
+
+        return self.actions[-1]
+
+
+class PolicyTree:
+    # Action values of a solved history tree stored in flat arrays. Nodes are indexed by histories (states, actions)
+    # like q_star, and the children of each node are sorted by action * n_states + next state.
+    arrays = ['root_states', 'root_nodes', 'parents', 'q', 'child_indptr', 'child_keys', 'child_nodes']
+
+    def __init__(self, n_states, root_states, root_nodes, parents, q, child_indptr, child_keys, child_nodes):
+        self.n_states = n_states
+        self.root_states = root_states
+        self.root_nodes = root_nodes
+        self.parents = parents
+        self.q = q
+        self.child_indptr = child_indptr
+        self.child_keys = child_keys
+        self.child_nodes = child_nodes
+
+    @classmethod
+    def from_history_tree(cls, tree, layer_values, n_states, n_actions, dtype=np.float64):
+        offsets = np.cumsum([0] + [len(action_values) for action_values in layer_values])
+        n_nodes = offsets[-1]
+
+        q = np.zeros((0, n_actions), dtype=dtype)
+        root_states, root_nodes = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        if layer_values:
+            q = np.concatenate(layer_values).astype(dtype)
+
+            root_states = np.array([tree.histories[0][node][0][0] for node in tree.roots], dtype=int)
+            order = np.argsort(root_states)
+            root_states, root_nodes = root_states[order], tree.roots[order]
+
+        # Edges into the last layer lead to leaves, which have no action values
+        nodes, keys, children = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+        for depth in range(len(layer_values) - 1):
+            node, action, state, _, child = tree.edges[depth]
+            nodes.append(offsets[depth] + node)
+            keys.append(action * n_states + state)
+            children.append(offsets[depth + 1] + child)
+
+        nodes, keys, children = np.concatenate(nodes), np.concatenate(keys), np.concatenate(children)
+        order = np.lexsort((keys, nodes))
+        nodes, keys, children = nodes[order], keys[order], children[order]
+
+        # With transpositions, a node may have several parents, of which the first is kept
+        parents = np.full(n_nodes, -1)
+        parents[children[::-1]] = nodes[::-1]
+
+        child_indptr = np.concatenate([[0], np.cumsum(np.bincount(nodes, minlength=n_nodes))])
+
+        return cls(n_states, root_states, root_nodes, parents, q, child_indptr, keys, children)
+
+    # A PolicyTree of action values indexed by histories (states, actions) in a dict, as returned by optimal_values
+    @classmethod
+    def from_q_star(cls, q_star):
+        histories = list(q_star)
+        index = {history: i for i, history in enumerate(histories)}
+        n_states = 1 + max((max(states) for states, _ in histories), default=-1)
+
+        q = np.array([q_star[history] for history in histories]).reshape(len(histories), -1) if histories else np.zeros((0, 0))
+
+        root_states, root_nodes, nodes, keys = [], [], [], []
+        for i, (states, actions) in enumerate(histories):
+            if len(states) == 1:
+                root_states.append(states[0])
+                root_nodes.append(i)
+            else:
+                nodes.append(index[states[:-1], actions[:-1]])
+                keys.append(actions[-1] * n_states + states[-1])
+
+        children = np.array([i for i, (states, _) in enumerate(histories) if len(states) > 1], dtype=int)
+        nodes, keys = np.array(nodes, dtype=int), np.array(keys, dtype=int)
+        order = np.lexsort((keys, nodes))
+        nodes, keys, children = nodes[order], keys[order], children[order]
+
+        parents = np.full(len(histories), -1)
+        parents[children] = nodes
+
+        root_states, root_nodes = np.array(root_states, dtype=int), np.array(root_nodes, dtype=int)
+        order = np.argsort(root_states)
+
+        child_indptr = np.concatenate([[0], np.cumsum(np.bincount(nodes, minlength=len(histories)))])
+        return cls(n_states, root_states[order], root_nodes[order], parents, q, child_indptr, keys, children)
+
+    def node(self, states, actions):
+        if len(states) == 0:
+            raise KeyError((states, actions))
+
+        i = np.searchsorted(self.root_states, states[0])
+        if i == len(self.root_states) or self.root_states[i] != states[0]:
+            raise KeyError((states, actions))
+
+        node = self.root_nodes[i]
+        for t in range(len(actions)):
+            node = self.child(node, actions[t], states[t + 1])
+            if node < 0:
+                raise KeyError((states, actions))
+
+        return node
+
+    def child(self, node, action, next_state):
+        if not 0 <= next_state < self.n_states:
+            return -1
+
+        start, end = self.child_indptr[node], self.child_indptr[node + 1]
+        key = action * self.n_states + next_state
+
+        i = start + np.searchsorted(self.child_keys[start:end], key)
+        if i == end or self.child_keys[i] != key:
+            return -1
+
+        return self.child_nodes[i]
 
-        return self._policy[states]
+    # Nodes reached by following the greedy actions along each row of a (n_histories, n_steps) array of states, or -1
+    # for histories that leave the tree
+    def follow(self, states):
+        states = np.asarray(states, dtype=int)
+        if len(self.root_states) == 0:
+            return np.full(len(states), -1)
+
+        i = np.minimum(np.searchsorted(self.root_states, states[:, 0]), len(self.root_states) - 1)
+        nodes = np.where(self.root_states[i] == states[:, 0], self.root_nodes[i], -1)
+
+        for t in range(1, states.shape[1]):
+            nodes[(states[:, t] < 0) | (states[:, t] >= self.n_states)] = -1
+            active = np.flatnonzero(nodes >= 0)
+            keys = np.argmax(self.q[nodes[active]], axis=1) * self.n_states + states[active, t]
+
+            # Vectorized binary search for each key among the sorted keys of the children of its node
+            start, end = self.child_indptr[nodes[active]], self.child_indptr[nodes[active] + 1]
+            low, high = start.copy(), end.copy()
+            while np.any(low < high):
+                searching = np.flatnonzero(low < high)
+                middle = (low[searching] + high[searching]) // 2
+                below = self.child_keys[middle] < keys[searching]
+                low[searching[below]] = middle[below] + 1
+                high[searching[~below]] = middle[~below]
+
+            found = np.zeros(len(active), dtype=bool)
+            found[low < end] = self.child_keys[low[low < end]] == keys[low < end]
+
+            nodes[active] = -1
+            nodes[active[found]] = self.child_nodes[low[found]]
+
+        return nodes
+
+    def __getitem__(self, key):
+        return self.q[self.node(*key)]
+
+    def __contains__(self, key):
+        try:
+            self.node(*key)
+        except KeyError:
+            return False
+
+        return True
+
+    def __len__(self):
+        return len(self.q)
+
+    # Paths ending in .npz are saved to a single file, and other paths to a directory of .npy files that can be
+    # memory-mapped by load
+    def save(self, path):
+        arrays = {name: getattr(self, name) for name in self.arrays}
+        arrays['n_states'] = np.array(self.n_states)
+
+        if path.endswith('.npz'):
+            np.savez(path, **arrays)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for name, array in arrays.items():
+                np.save(os.path.join(path, f'{name}.npy'), array)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        if path.endswith('.npz'):
+            arrays = dict(np.load(path))
+        else:
+            arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+                      for name in cls.arrays + ['n_states']}
+
+        return cls(int(arrays.pop('n_states')), **arrays)
+
+
+class PolicyTreeWriter:
+    # Writes a PolicyTree to a directory of .npy files (see PolicyTree.save) one node at a time, children before their
+    # parents. Nodes are buffered until they take buffer_size bytes and then appended to raw files, so that memory use
+    # does not grow with the tree. The children of a node are given as keys action * n_states + next state.
+    def __init__(self, directory, n_states, n_actions, dtype=np.float64, buffer_size=2 ** 24):
+        self.directory = directory
+        self.n_states = n_states
+        self.n_actions = n_actions
+        self.dtype = np.dtype(dtype)
+        self.buffer_size = buffer_size
+
+        self.n_nodes = 0
+        self._buffers = {'q': bytearray(), 'child_counts': bytearray(), 'child_keys': bytearray(), 'child_nodes': bytearray()}
+
+        os.makedirs(directory, exist_ok=True)
+        for name in self._buffers:
+            open(self._raw_path(name), 'wb').close()
+
+    def _raw_path(self, name):
+        return os.path.join(self.directory, f'{name}.raw')
+
+    def add(self, q, keys, children):
+        order = np.argsort(keys, kind='stable')
+
+        self._buffers['q'] += np.asarray(q, dtype=self.dtype).tobytes()
+        self._buffers['child_counts'] += np.int64(len(keys)).tobytes()
+        self._buffers['child_keys'] += np.asarray(keys, dtype=np.int64)[order].tobytes()
+        self._buffers['child_nodes'] += np.asarray(children, dtype=np.int64)[order].tobytes()
+
+        if sum(len(buffer) for buffer in self._buffers.values()) >= self.buffer_size:
+            self.flush()
+
+        self.n_nodes += 1
+        return self.n_nodes - 1
+
+    def flush(self):
+        for name, buffer in self._buffers.items():
+            with open(self._raw_path(name), 'ab') as f:
+                f.write(buffer)
+
+            self._buffers[name] = bytearray()
+
+    def _raw(self, name, dtype):
+        n = os.path.getsize(self._raw_path(name)) // np.dtype(dtype).itemsize
+        if n == 0:
+            return np.zeros(0, dtype=dtype)
+
+        return np.memmap(self._raw_path(name), dtype=dtype, mode='r', shape=(n,))
+
+    def _chunks(self, n):
+        size = max(1, self.buffer_size // 8)
+        return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+    # Converts the raw files into a PolicyTree and returns it memory-mapped
+    def close(self, root_states, root_nodes):
+        self.flush()
+        order = np.argsort(root_states)
+
+        arrays = {'n_states': np.array(self.n_states), 'root_states': np.asarray(root_states, dtype=int)[order],
+                  'root_nodes': np.asarray(root_nodes, dtype=int)[order]}
+        for name, array in arrays.items():
+            np.save(os.path.join(self.directory, f'{name}.npy'), array)
+
+        q = np.lib.format.open_memmap(os.path.join(self.directory, 'q.npy'), mode='w+', dtype=self.dtype,
+                                      shape=(self.n_nodes, self.n_actions))
+        raw_q = self._raw('q', self.dtype).reshape(-1, self.n_actions) if self.n_nodes > 0 else q
+        for start, end in self._chunks(self.n_nodes):
+            q[start:end] = raw_q[start:end]
+
+        counts = self._raw('child_counts', np.int64)
+        child_indptr = np.lib.format.open_memmap(os.path.join(self.directory, 'child_indptr.npy'), mode='w+',
+                                                 dtype=np.int64, shape=(self.n_nodes + 1,))
+        child_indptr[0] = 0
+        for start, end in self._chunks(self.n_nodes):
+            child_indptr[start + 1:end + 1] = child_indptr[start] + np.cumsum(counts[start:end])
+
+        n_edges = int(child_indptr[-1])
+        for name in ['child_keys', 'child_nodes']:
+            array = np.lib.format.open_memmap(os.path.join(self.directory, f'{name}.npy'), mode='w+', dtype=np.int64,
+                                              shape=(n_edges,))
+            raw = self._raw(name, np.int64)
+            for start, end in self._chunks(n_edges):
+                array[start:end] = raw[start:end]
+            array.flush()
+
+        # With transpositions, a node may have several parents, of which the first is kept
+        parents = np.lib.format.open_memmap(os.path.join(self.directory, 'parents.npy'), mode='w+', dtype=np.int64,
+                                            shape=(self.n_nodes,))
+        parents[:] = -1
+        child_nodes = np.load(os.path.join(self.directory, 'child_nodes.npy'), mmap_mode='r')
+        for start, end in self._chunks(n_edges):
+            nodes = np.searchsorted(child_indptr, np.arange(start, end), side='right') - 1
+            children = child_nodes[start:end]
+
+            unset = parents[children] < 0
+            parents[children[unset][::-1]] = nodes[unset][::-1]
+
+        for array in [q, child_indptr, parents]:
+            array.flush()
+        del q, child_indptr, parents, child_nodes
+
+        for name in self._buffers:
+            os.remove(self._raw_path(name))
+
+        return PolicyTree.load(self.directory, mmap_mode='r')
+
+
+class HistoryTree:
+    def __init__(self, initial_distribution, horizon, policy=None, transpositions=False):
+        self.initial_distribution = initial_distribution
+        self.horizon = horizon
+        self.policy = policy
+        self.transpositions = transpositions
+
+        # Nodes at each depth, indexed by position within their layer
+        self.keys = []
+        self.histories = []
+        self.beliefs = []
+
+        # Edges from each depth to the next, as arrays of (node, action, next state, probability, child)
+        self.edges = []
+
+        self.roots = np.zeros(0, dtype=int)
+        self.root_probabilities = np.zeros(0)
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys)
+
+    # The tree of the descendants of a node in the second layer, which becomes its only root. If relative is True, the
+    # first step of every history is dropped, so that histories start at the new root and do not grow with the
+    # number of subtrees taken. This is only valid if the BAMDP has sufficient beliefs.
+    def subtree(self, node, relative=False):
+        tree = HistoryTree(self.initial_distribution, self.horizon - 1, self.policy, self.transpositions)
+        tree.roots = np.zeros(1, dtype=int)
+        tree.root_probabilities = np.ones(1)
+
+        keep = np.zeros(len(self.keys[1]), dtype=bool)
+        keep[node] = True
+        for depth in range(1, len(self.keys)):
+            tree.keys.append([key for key, kept in zip(self.keys[depth], keep) if kept])
+            histories = [history for history, kept in zip(self.histories[depth], keep) if kept]
+            tree.histories.append([(states[1:], actions[1:]) for states, actions in histories] if relative else histories)
+            tree.beliefs.append([belief for belief, kept in zip(self.beliefs[depth], keep) if kept])
+
+            if depth < len(self.edges):
+                nodes, actions, states, probabilities, children = self.edges[depth]
+                edges = keep[nodes]
+
+                next_keep = np.zeros(len(self.keys[depth + 1]), dtype=bool)
+                next_keep[children[edges]] = True
+
+                index, next_index = np.cumsum(keep) - 1, np.cumsum(next_keep) - 1
+                tree.edges.append((index[nodes[edges]], actions[edges], states[edges], probabilities[edges],
+                                   next_index[children[edges]]))
+
+                keep = next_keep
+
+        return tree
+
+
+class SolverStats:
+    # Counters collected by an instrumented BAMDP. If hook is not None, it is called as hook(depth, stats) whenever a
+    # node is expanded.
+    def __init__(self, hook=None):
+        self.hook = hook
+
+        self.nodes = collections.Counter()
+        self.predictive_calls = collections.Counter()
+        self.predictive_time = collections.Counter()
+        self.skipped_successors = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.pruned = 0
+
+    def record_node(self, depth):
+        self.nodes[depth] += 1
+        if self.hook is not None:
+            self.hook(depth, self)
+
+    def record_predictive(self, depth, elapsed, n_skipped):
+        self.predictive_calls[depth] += 1
+        self.predictive_time[depth] += elapsed
+        self.skipped_successors += n_skipped
+
+    def hit_rate(self):
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups > 0 else 0.
+
+    def as_dict(self):
+        return {'nodes': dict(self.nodes),
+                'predictive_calls': dict(self.predictive_calls),
+                'predictive_time': dict(self.predictive_time),
+                'skipped_successors': self.skipped_successors,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+                'hit_rate': self.hit_rate(),
+                'pruned': self.pruned}
+
+
+# Rough size of a hyperstate or history entry in a dict, used to turn a memory budget into a number of entries
+_ENTRY_BYTES = 512
+
+
+# Each worker process receives the BAMDP once, when it starts, rather than once per subtree
+_worker_bamdp = None
+
+
+def _initialize_worker(bamdp):
+    global _worker_bamdp
+    _worker_bamdp = bamdp
+
+
+def _optimal_subtree_values(initial_distribution, horizon, states, actions, belief, transpositions, pruning):
+    q_star = {}
+    action_values = _worker_bamdp.optimal_values(initial_distribution, horizon, states, actions, q_star, transpositions, belief, pruning)
+    return action_values, q_star
 
 
 class BAMDP:
+    # Beliefs are sufficient if predictions and belief updates depend on the history only through the belief and the
+    # last state and action, and hyperstates of histories of equal length only through the belief and the last state
+    sufficient_beliefs = False
+
     def __init__(self, n_states, n_actions, reward, discount):
         self.n_states = n_states
         self.n_actions = n_actions
         self.reward = reward
         self.discount = discount
 
+        self.stats = None
+
+    # Arrays and parameters that define the problem, so that equal problems have equal parameters
+    def parameters(self):
+        return {'reward': np.asarray(self.reward, dtype=float), 'discount': np.asarray(self.discount, dtype=float)}
+
+    # Starts collecting SolverStats, which accumulate until stats is set to None. They are the only record of
+    # transposition hits and misses and of branches abandoned by pruning. Subtrees solved by worker processes are not
+    # counted.
+    def instrument(self, hook=None):
+        self.stats = SolverStats(hook)
+        return self.stats
+
     def posterior_predictive(self, initial_distribution, states, actions):
         raise NotImplementedError()
 
+    # A belief summarizes the history seen so far. By default, the belief is the initial distribution and
+    # predictions are made from the whole history.
+    def initial_belief(self, initial_distribution, state):
+        return initial_distribution
+
+    def update_belief(self, belief, state, action, next_state):
+        return belief
+
+    def predictive(self, belief, states, actions):
+        return self.posterior_predictive(belief, states, actions)
+
+    def belief(self, initial_distribution, states, actions):
+        belief = self.initial_belief(initial_distribution, states[0])
+        for j in range(len(states) - 1):
+            belief = self.update_belief(belief, states[j], actions[j], states[j + 1])
+
+        return belief
+
+    # The posterior over models given the history, from which sample_posterior draws models. Planners that draw many
+    # models at the same history compute it once.
+    def posterior(self, initial_distribution, states, actions):
+        raise NotImplementedError()
+
+    def sample_posterior(self, posterior, random_state):
+        raise NotImplementedError()
+
+    # Draws a Model from the posterior given the history
+    def sample_model(self, initial_distribution, states, actions, random_state):
+        return self.sample_posterior(self.posterior(initial_distribution, states, actions), random_state)
+
+    def predictive_successors(self, belief, states, actions):
+        next_states, probabilities = _nonzero(self.predictive(belief, states, actions))
+        return next_states.tolist(), probabilities.tolist()
+
+    def _successors(self, belief, states, actions):
+        if self.stats is None:
+            return self.predictive_successors(belief, states, actions)
+
+        start = time.perf_counter()
+        next_states, probabilities = self.predictive_successors(belief, states, actions)
+        self.stats.record_predictive(len(states) - 1, time.perf_counter() - start, self.n_states - len(next_states))
+
+        return next_states, probabilities
+
+    def hyperstate(self, initial_distribution, states, actions, belief=None):
+        return tuple(states), tuple(actions)
+
+    # Bounds on the discounted sum of rewards over a number of steps
+    def value_bounds(self, steps):
+        if self.discount == 1:
+            total = steps
+        else:
+            total = (1 - self.discount ** steps) / (1 - self.discount)
+
+        return np.min(self.reward) * total, np.max(self.reward) * total
+
+    # Upper bound on the value of a hyperstate with a number of steps left. By default, the bound ignores the belief.
+    def upper_bound(self, belief, state, steps):
+        return self.value_bounds(steps)[1]
+
     def effective_horizon(self, epsilon):
         c = np.max(np.abs(self.reward))
         return int(np.log(( epsilon * (1 - self.discount) ) / (2 * c)) / np.log(self.discount) + 1)
 
-    def value(self, initial_distribution, policy, horizon, states=[], actions=[]):
+    # If transpositions is True, the policy must choose the same action for histories that share a hyperstate
+    def value(self, initial_distribution, policy, horizon, states=[], actions=[], belief=None, transpositions=False, values=None):
         v = 0.
         if len(states) == 0:
+            values = {}
             for state, probability in enumerate(initial_distribution):
                 if not np.allclose(probability, 0):
-                    v += probability * self.value(initial_distribution, policy, horizon, [state], [])
+                    belief = self.initial_belief(initial_distribution, state)
+                    v += probability * self.value(initial_distribution, policy, horizon, [state], [], belief, transpositions, values)
         elif len(states) - 1 < horizon:
-            actions = actions + [policy[tuple(states)]]
-            probabilities = self.posterior_predictive(initial_distribution, states, actions)
-            for state, probability in enumerate(probabilities):
-                if not np.allclose(probability, 0):
-                    next_v = self.value(initial_distribution, policy, horizon, states + [state], actions)
-                    v += probability * (self.reward[state] + self.discount * next_v)
+            if transpositions:
+                key = self.hyperstate(initial_distribution, states, actions, belief)
+                if key in values:
+                    if self.stats is not None:
+                        self.stats.cache_hits += 1
+                    return values[key]
+                if self.stats is not None:
+                    self.stats.cache_misses += 1
+
+            if self.stats is not None:
+                self.stats.record_node(len(states) - 1)
+
+            action = policy[tuple(states)]
+            next_actions = actions + [action]
+            for state, probability in zip(*self._successors(belief, states, next_actions)):
+                next_belief = self.update_belief(belief, states[-1], action, state)
+                next_v = self.value(initial_distribution, policy, horizon, states + [state], next_actions, next_belief, transpositions, values)
+                v += probability * (self.reward[state] + self.discount * next_v)
+
+            if transpositions:
+                values[key] = v
 
         return v
 
-    def optimal_values(self, initial_distribution, horizon, states=[], actions=[], q_star=None):
+    # Estimates value by rolling the policy out in models drawn from the prior. Each batch draws n_models models and
+    # simulates episodes_per_model episodes in each, all starting from the same initial state. Sampling stops once
+    # the standard error falls to precision, or after max_models models. Returns the mean and its standard error.
+    def monte_carlo_value(self, initial_distribution, policy, horizon, precision=None, n_models=100,
+                          episodes_per_model=10, max_models=10000, seed=None):
+        random_state = np.random.RandomState(seed)
+        discounts = self.discount ** np.arange(horizon)
+
+        # The mean return in each sampled model is an independent sample of the value
+        returns = []
+        while len(returns) < max_models:
+            initial_states = random_state.choice(self.n_states, size=min(n_models, max_models - len(returns)),
+                                                 p=initial_distribution)
+
+            # Sparse transitions of every distinct model in the batch, whose rows follow each other as in
+            # Model.simulate_batch. The models are kept so that their ids are not reused.
+            models = [self.sample_model(initial_distribution, [state], [], random_state) for state in initial_states.tolist()]
+
+            distinct = {}
+            for model in models:
+                distinct.setdefault(id(model), (len(distinct), model))
+            indices = [distinct[id(model)][0] for model in models]
+
+            n_rows = self.n_states * self.n_actions
+            keys, successor_states = [], []
+            for i, model in distinct.values():
+                indptr, next_states, probabilities = model.sparse_transitions()
+                keys.append(i * n_rows + _sampling_keys(indptr, probabilities))
+                successor_states.append(next_states)
+            keys, successor_states = np.concatenate(keys), np.concatenate(successor_states)
+
+            episode_models = np.repeat(indices, episodes_per_model)
+
+            states = np.zeros((len(episode_models), horizon + 1), dtype=int)
+            states[:, 0] = np.repeat(initial_states, episodes_per_model)
+
+            for t in range(horizon):
+                actions = policy.batch_actions(states[:, :t + 1])
+                rows = episode_models * n_rows + states[:, t] * self.n_actions + actions
+                states[:, t + 1] = successor_states[np.searchsorted(keys, rows + random_state.random_sample(len(rows)), side='right')]
+
+            episode_returns = np.asarray(self.reward)[states[:, 1:]] @ discounts
+            returns.extend(np.mean(episode_returns.reshape(-1, episodes_per_model), axis=1).tolist())
+
+            standard_error = np.std(returns, ddof=1) / np.sqrt(len(returns)) if len(returns) > 1 else np.inf
+            if precision is not None and standard_error <= precision:
+                break
+
+        return float(np.mean(returns)), float(standard_error)
+
+    # If pruning is True, an action is abandoned as soon as an upper bound on its value falls clearly below the value
+    # of another action. The stored value of such an action is that upper bound, so that the greedy policy is unchanged.
+    def optimal_values(self, initial_distribution, horizon, states=[], actions=[], q_star=None, transpositions=False, belief=None, pruning=False):
         if len(states) == 0:
             q_star = {}
             for state, probability in enumerate(initial_distribution):
                 if not np.allclose(probability, 0):
-                    self.optimal_values(initial_distribution, horizon, [state], [], q_star)
+                    belief = self.initial_belief(initial_distribution, state)
+                    self.optimal_values(initial_distribution, horizon, [state], [], q_star, transpositions, belief, pruning)
 
             return q_star
 
         action_values = np.zeros(self.n_actions)
 
         if len(states) - 1 < horizon:
-            for action in range(self.n_actions):
-                probabilities = self.posterior_predictive(initial_distribution, states, actions + [action])
-                for state, probability in enumerate(probabilities):
-                    if not np.allclose(probability, 0):
-                        next_values = self.optimal_values(initial_distribution, horizon, states + [state], actions + [action], q_star)
-                        action_values[action] += probability * (self.reward[state] + self.discount * np.max(next_values))
+            # Histories that share a hyperstate share their action values
+            if transpositions:
+                key = self.hyperstate(initial_distribution, states, actions, belief)
+                if key in q_star:
+                    if self.stats is not None:
+                        self.stats.cache_hits += 1
+                    return q_star[key]
+                if self.stats is not None:
+                    self.stats.cache_misses += 1
+            else:
+                key = (tuple(states), tuple(actions))
+
+            if self.stats is not None:
+                self.stats.record_node(len(states) - 1)
+
+            successors = [self._successors(belief, states, actions + [action]) for action in range(self.n_actions)]
 
-            q_star[(tuple(states), tuple(actions))] = action_values
+            order = range(self.n_actions)
+            if pruning:
+                # Bounds on the value of each action from its immediate rewards and bounds on the values of its successors
+                steps = horizon - len(states)
+                lower_next = self.value_bounds(steps)[0]
+                upper_next = [[self.upper_bound(self.update_belief(belief, states[-1], a, s), s, steps) for s in successors[a][0]]
+                              for a in order]
+                lower = [sum(p * (self.reward[s] + self.discount * lower_next) for s, p in zip(*successors[a])) for a in order]
+                upper = [sum(p * (self.reward[s] + self.discount * u) for s, p, u in zip(*successors[a], upper_next[a]))
+                         for a in order]
+
+                best = max(lower)
+                order = np.argsort(upper, kind='stable')[::-1]
+
+            for action in order:
+                next_states, probabilities = successors[action]
+                if pruning:
+                    optimistic = upper[action]
+
+                for j, (state, probability) in enumerate(zip(next_states, probabilities)):
+                    if pruning and optimistic < best and not np.isclose(optimistic, best):
+                        if self.stats is not None:
+                            self.stats.pruned += len(next_states) - j
+                        action_values[action] = optimistic
+                        break
+
+                    next_belief = self.update_belief(belief, states[-1], action, state)
+                    next_values = self.optimal_values(initial_distribution, horizon, states + [state], actions + [action], q_star, transpositions, next_belief, pruning)
+                    action_values[action] += probability * (self.reward[state] + self.discount * np.max(next_values))
+
+                    if pruning:
+                        optimistic -= probability * self.discount * (upper_next[action][j] - np.max(next_values))
+                else:
+                    if pruning:
+                        best = max(best, action_values[action])
+
+            q_star[key] = action_values
 
         return action_values
 
-    def solve(self, initial_distribution, horizon):
-        return OptimalPolicy(self.optimal_values(initial_distribution, horizon))
+    # Depth-first solving that writes action values to a PolicyTreeWriter as soon as a subtree is complete. Only the
+    # current history and the children of its nodes are kept in memory, along with at most max_transpositions
+    # hyperstates, of which the least recently used are forgotten.
+    def spilled_optimal_values(self, initial_distribution, horizon, directory, transpositions=False, dtype=np.float64,
+                               buffer_size=2 ** 24, max_transpositions=2 ** 16):
+        writer = PolicyTreeWriter(directory, self.n_states, self.n_actions, dtype, buffer_size)
+        table = collections.OrderedDict()
+
+        root_states, root_nodes = [], []
+        if horizon > 0:
+            for state, probability in enumerate(initial_distribution):
+                if not np.allclose(probability, 0):
+                    belief = self.initial_belief(initial_distribution, state)
+                    node, _ = self._spill_values(initial_distribution, horizon, [state], [], belief, writer,
+                                                 transpositions, table, max_transpositions)
+                    root_states.append(state)
+                    root_nodes.append(node)
+
+        return writer.close(root_states, root_nodes)
+
+    def _spill_values(self, initial_distribution, horizon, states, actions, belief, writer, transpositions, table,
+                      max_transpositions):
+        if transpositions:
+            key = self.hyperstate(initial_distribution, states, actions, belief)
+            if key in table:
+                table.move_to_end(key)
+                if self.stats is not None:
+                    self.stats.cache_hits += 1
+                return table[key]
+            if self.stats is not None:
+                self.stats.cache_misses += 1
+
+        if self.stats is not None:
+            self.stats.record_node(len(states) - 1)
+
+        action_values = np.zeros(self.n_actions)
+        keys, children = [], []
+        for action in range(self.n_actions):
+            for state, probability in zip(*self._successors(belief, states, actions + [action])):
+                next_value = 0.
+
+                # Leaves have no action values, so they are not written
+                if len(states) < horizon:
+                    next_belief = self.update_belief(belief, states[-1], action, state)
+                    child, next_value = self._spill_values(initial_distribution, horizon, states + [state],
+                                                           actions + [action], next_belief, writer, transpositions,
+                                                           table, max_transpositions)
+                    keys.append(action * self.n_states + state)
+                    children.append(child)
+
+                action_values[action] += probability * (self.reward[state] + self.discount * next_value)
+
+        result = writer.add(action_values, keys, children), np.max(action_values)
+
+        if transpositions:
+            table[key] = result
+            if len(table) > max_transpositions:
+                table.popitem(last=False)
+
+        return result
+
+    def parallel_optimal_values(self, initial_distribution, horizon, n_jobs, transpositions=False, pruning=False):
+        q_star = {}
+        if horizon == 0:
+            return q_star
+
+        with ProcessPoolExecutor(n_jobs, initializer=_initialize_worker, initargs=(self,)) as executor:
+            # The subtrees below each initial state, action and next state are solved independently
+            roots = []
+            for root, probability in enumerate(initial_distribution):
+                if not np.allclose(probability, 0):
+                    belief = self.initial_belief(initial_distribution, root)
+
+                    subtrees = []
+                    for action in range(self.n_actions):
+                        for state, probability in zip(*self._successors(belief, [root], [action])):
+                            next_belief = self.update_belief(belief, root, action, state)
+                            future = executor.submit(_optimal_subtree_values, initial_distribution, horizon,
+                                                     [root, state], [action], next_belief, transpositions, pruning)
+                            subtrees.append((action, state, probability, future))
+
+                    roots.append((root, belief, subtrees))
+
+            for root, belief, subtrees in roots:
+                action_values = np.zeros(self.n_actions)
+                for action, state, probability, future in subtrees:
+                    next_values, subtree_q_star = future.result()
+                    q_star.update(subtree_q_star)
+                    action_values[action] += probability * (self.reward[state] + self.discount * np.max(next_values))
+
+                if transpositions:
+                    q_star[self.hyperstate(initial_distribution, [root], [], belief)] = action_values
+                else:
+                    q_star[((root,), ())] = action_values
+
+        return q_star
+
+    def expand(self, initial_distribution, horizon, policy=None, transpositions=False):
+        tree = HistoryTree(initial_distribution, 0, policy, transpositions)
+
+        nodes, histories, beliefs = {}, [], []
+        roots, root_probabilities = [], []
+        for state, probability in enumerate(initial_distribution):
+            if not np.allclose(probability, 0):
+                belief = self.initial_belief(initial_distribution, state)
+                if transpositions:
+                    key = self.hyperstate(initial_distribution, [state], [], belief)
+                else:
+                    key = ((state,), ())
+
+                if key not in nodes:
+                    nodes[key] = len(histories)
+                    histories.append(((state,), ()))
+                    beliefs.append(belief)
+
+                roots.append(nodes[key])
+                root_probabilities.append(probability)
+
+        tree.roots = np.array(roots, dtype=int)
+        tree.root_probabilities = np.array(root_probabilities)
+
+        tree.keys.append(list(nodes))
+        tree.histories.append(histories)
+        tree.beliefs.append(beliefs)
+
+        for _ in range(horizon):
+            self.expand_layer(tree)
+
+        return tree
+
+    # A tree whose only root is the given history. If belief is None, it is computed from the history.
+    def history_tree(self, initial_distribution, states, actions, transpositions=False, belief=None):
+        tree = HistoryTree(initial_distribution, 0, transpositions=transpositions)
+        tree.roots = np.zeros(1, dtype=int)
+        tree.root_probabilities = np.ones(1)
+
+        if belief is None:
+            belief = self.belief(initial_distribution, states, actions)
+        if transpositions:
+            key = self.hyperstate(initial_distribution, states, actions, belief)
+        else:
+            key = (tuple(states), tuple(actions))
+
+        tree.keys.append([key])
+        tree.histories.append([(tuple(states), tuple(actions))])
+        tree.beliefs.append([belief])
+
+        return tree
+
+    # Adds the children of the nodes in the last layer of a tree
+    def expand_layer(self, tree):
+        next_nodes, next_histories, next_beliefs = {}, [], []
+        edges = []
+        for i, ((states, actions), belief) in enumerate(zip(tree.histories[-1], tree.beliefs[-1])):
+            if self.stats is not None:
+                self.stats.record_node(len(states) - 1)
+
+            node_actions = range(self.n_actions) if tree.policy is None else [tree.policy[states]]
+            for action in node_actions:
+                next_actions = actions + (action,)
+                for state, probability in zip(*self._successors(belief, states, next_actions)):
+                    next_states = states + (state,)
+                    next_belief = self.update_belief(belief, states[-1], action, state)
+                    if tree.transpositions:
+                        key = self.hyperstate(tree.initial_distribution, next_states, next_actions, next_belief)
+                    else:
+                        key = (next_states, next_actions)
+
+                    if self.stats is not None and tree.transpositions:
+                        if key in next_nodes:
+                            self.stats.cache_hits += 1
+                        else:
+                            self.stats.cache_misses += 1
+
+                    if key not in next_nodes:
+                        next_nodes[key] = len(next_histories)
+                        next_histories.append((next_states, next_actions))
+                        next_beliefs.append(next_belief)
+
+                    edges.append((i, action, state, probability, next_nodes[key]))
+
+        edges = np.array(edges, dtype=float).reshape(-1, 5)
+        tree.edges.append((edges[:, 0].astype(int), edges[:, 1].astype(int), edges[:, 2].astype(int),
+                           edges[:, 3], edges[:, 4].astype(int)))
+
+        tree.keys.append(list(next_nodes))
+        tree.histories.append(next_histories)
+        tree.beliefs.append(next_beliefs)
+        tree.horizon += 1
+
+    def backup(self, tree):
+        reward = np.asarray(self.reward, dtype=float)
+
+        layer_values = [None] * len(tree.edges)
+        next_values = np.zeros(len(tree.keys[-1]))
+        for depth in reversed(range(len(tree.edges))):
+            node, action, state, probability, child = tree.edges[depth]
+
+            action_values = np.zeros((len(tree.keys[depth]), self.n_actions))
+            np.add.at(action_values, (node, action), probability * (reward[state] + self.discount * next_values[child]))
+            layer_values[depth] = action_values
+
+            # Actions not chosen by a policy contribute zero
+            next_values = action_values.max(axis=1) if tree.policy is None else action_values.sum(axis=1)
+
+        return layer_values
+
+    def layered_value(self, initial_distribution, policy, horizon, transpositions=False):
+        tree = self.expand(initial_distribution, horizon, policy, transpositions)
+        if horizon == 0:
+            return 0.
+
+        values = self.backup(tree)[0].sum(axis=1)
+        return np.sum(tree.root_probabilities * values[tree.roots])
+
+    def layered_optimal_values(self, initial_distribution, horizon, transpositions=False):
+        tree = self.expand(initial_distribution, horizon, transpositions=transpositions)
+
+        q_star = {}
+        for keys, action_values in zip(tree.keys, self.backup(tree)):
+            q_star.update(zip(keys, action_values))
+
+        return q_star
+
+    def compact_optimal_values(self, initial_distribution, horizon, transpositions=False, dtype=np.float64):
+        tree = self.expand(initial_distribution, horizon, transpositions=transpositions)
+        return PolicyTree.from_history_tree(tree, self.backup(tree), self.n_states, self.n_actions, dtype)
+
+    # Backs up action values for a batch of settings at once, with rewards of shape (n_settings, n_states) and
+    # discounts of shape (n_settings,), over the first horizon layers of a tree (all of them by default). Returns the
+    # action values of each layer as (n_settings, n_nodes, n_actions) arrays.
+    def batch_backup(self, tree, rewards, discounts, horizon=None):
+        if horizon is None:
+            horizon = len(tree.edges)
+
+        rewards = np.asarray(rewards, dtype=float)
+        discounts = np.asarray(discounts, dtype=float)[:, np.newaxis]
+
+        layer_values = [None] * horizon
+        next_values = np.zeros((len(rewards), len(tree.keys[horizon])))
+        for depth in reversed(range(horizon)):
+            node, action, state, probability, child = tree.edges[depth]
+
+            action_values = np.zeros((len(rewards), len(tree.keys[depth]), self.n_actions))
+            np.add.at(action_values, (slice(None), node, action), probability * (rewards[:, state] + discounts * next_values[:, child]))
+            layer_values[depth] = action_values
+
+            next_values = action_values.max(axis=2)
+
+        return layer_values
+
+    # Solves the problem for every (reward, discount) setting and every horizon up to the given one, expanding the
+    # history tree only once, since neither its structure nor its probabilities depend on rewards or discounts. rewards
+    # and discounts default to those of the BAMDP, and a single reward vector or discount is shared by every setting.
+    # Returns policies[h][k], the compact optimal policy of setting k for horizon h, and values[h, k], its value.
+    def solve_batch(self, initial_distribution, horizon, rewards=None, discounts=None, transpositions=False, dtype=np.float64):
+        rewards = np.atleast_2d(self.reward if rewards is None else rewards).astype(float)
+        discounts = np.atleast_1d(self.discount if discounts is None else discounts).astype(float)
+        rewards, discounts = np.broadcast_arrays(rewards, discounts[:, np.newaxis])
+        discounts = discounts[:, 0]
+
+        tree = self.expand(initial_distribution, horizon, transpositions=transpositions)
+
+        policies = [[OptimalPolicy(PolicyTree.from_history_tree(tree, [], self.n_states, self.n_actions, dtype))
+                     for _ in range(len(rewards))]]
+        values = np.zeros((horizon + 1, len(rewards)))
+        for h in range(1, horizon + 1):
+            layer_values = self.batch_backup(tree, rewards, discounts, h)
+
+            # The tree structure is shared by the policies of every setting
+            structure = PolicyTree.from_history_tree(tree, [action_values[0] for action_values in layer_values],
+                                                     self.n_states, self.n_actions, dtype)
+            arrays = {name: getattr(structure, name) for name in PolicyTree.arrays if name != 'q'}
+
+            q = np.concatenate(layer_values, axis=1).astype(dtype)
+            policies.append([OptimalPolicy(PolicyTree(self.n_states, q=q[k], **arrays)) for k in range(len(rewards))])
+            values[h] = layer_values[0][:, tree.roots].max(axis=2) @ tree.root_probabilities
+
+        return policies, values
+
+    # A compact solution is indexed by histories even if transpositions are used while solving. A solution found in
+    # a SolveCache is always compact.
+    #
+    # If memory_budget is not None, action values are written to a memory-mapped PolicyTree in spill_directory as the
+    # solver goes, and the budget, in bytes, is shared between the write buffer, the transposition table and the
+    # policy cache. By default, spill_directory is a new temporary directory, which is deleted once the PolicyTree
+    # of the returned policy is garbage collected.
+    def solve(self, initial_distribution, horizon, transpositions=False, layered=False, n_jobs=1, compact=False, pruning=False,
+              cache=None, memory_budget=None, spill_directory=None, dtype=np.float64):
+        spilled = memory_budget is not None
+        if (compact or layered or cache is not None or spilled) and (n_jobs != 1 or pruning):
+            raise ValueError('Parallel solving and pruning are only supported by the recursive solver.')
+
+        if cache is not None:
+            return OptimalPolicy(cache.solve(self, initial_distribution, horizon, transpositions))
+
+        if spilled:
+            temporary = spill_directory is None
+            if temporary:
+                spill_directory = tempfile.mkdtemp(prefix='mtbrl-')
+
+            n_entries = max(1, memory_budget // (4 * _ENTRY_BYTES))
+            q_star = self.spilled_optimal_values(initial_distribution, horizon, spill_directory, transpositions, dtype,
+                                                 buffer_size=memory_budget // 2, max_transpositions=n_entries)
+            if temporary:
+                weakref.finalize(q_star, shutil.rmtree, spill_directory, ignore_errors=True)
+
+            return OptimalPolicy(q_star, cache_size=n_entries)
+
+        if compact:
+            return OptimalPolicy(self.compact_optimal_values(initial_distribution, horizon, transpositions, dtype))
+
+        if n_jobs != 1:
+            q_star = self.parallel_optimal_values(initial_distribution, horizon, n_jobs, transpositions, pruning)
+        elif layered:
+            q_star = self.layered_optimal_values(initial_distribution, horizon, transpositions)
+        else:
+            q_star = self.optimal_values(initial_distribution, horizon, transpositions=transpositions, pruning=pruning)
+
+        if transpositions:
+            return OptimalPolicy(q_star, functools.partial(self.hyperstate, initial_distribution), bamdp=self,
+                                 initial_distribution=initial_distribution)
+
+        return OptimalPolicy(q_star)
 
 
 class CountableBAMDP(BAMDP):
-    def __init__(self, models, prior, reward, discount):
+    sufficient_beliefs = True
+
+    def __init__(self, models, prior, reward, discount, decimals=8):
         BAMDP.__init__(self, models[0].n_states, models[0].n_actions, reward, discount)
         self.models = models
         self.prior = prior
 
-    def posterior_predictive(self, initial_distribution, states, actions):
-        probability_trajectory = np.zeros(len(self.models))
-        for i, p in enumerate(self.models):
-            probability_trajectory[i] = initial_distribution[states[0]] * self.prior[i]
+        # Posteriors that agree up to this number of decimals are considered equal by hyperstate
+        self.decimals = decimals
 
-            for j in range(len(states) - 1):
-                probability_trajectory[i] *= p(states[j], actions[j], states[j + 1])
+        # Transition probabilities of every model stacked into a single (n_models, n_successors) matrix, whose columns
+        # are the successors of each (s, a) under any model in compressed sparse row order
+        n_rows = self.n_states * self.n_actions
 
-        posterior_probability = np.zeros(self.n_states)
+        keys = []
+        for model in models:
+            indptr, next_states, _ = model.sparse_transitions()
+            keys.append(_expand_rows(indptr) * self.n_states + next_states)
+
+        union = np.unique(np.concatenate(keys))
+        self._successor_indptr = np.concatenate([[0], np.cumsum(np.bincount(union // self.n_states, minlength=n_rows))])
+        self._successor_states = union % self.n_states
+
+        self._successor_probabilities = np.zeros((len(models), len(union)))
+        for i, model in enumerate(models):
+            self._successor_probabilities[i, np.searchsorted(union, keys[i])] = model.sparse_transitions()[2]
+
+        # An (s, a) is informative if its transitions differ between models. The others leave the posterior unchanged,
+        # and their predictive distribution is shared by every belief.
+        differs = np.any(~np.isclose(self._successor_probabilities, self._successor_probabilities[0]), axis=0)
+        self.informative = (np.bincount(union // self.n_states, weights=differs, minlength=n_rows) > 0).reshape(self.n_states, self.n_actions)
+
+        # The successors of the non-informative (s, a) are listed the first time they are needed
+        self._shared_nonzero = ~np.isclose(self._successor_probabilities[0], 0)
+        self._shared_successors = {}
 
-        c = np.sum(probability_trajectory)
+        # Optimal values of each state in each model with a number of steps left, computed as needed by upper_bound
+        self._model_values = [np.zeros((len(models), self.n_states))]
+
+    def parameters(self):
+        return dict(BAMDP.parameters(self), successor_indptr=self._successor_indptr, successor_states=self._successor_states,
+                    successor_probabilities=self._successor_probabilities, prior=np.asarray(self.prior, dtype=float),
+                    decimals=np.asarray(self.decimals))
+
+    # Acting optimally with the model known is worth at least as much as acting optimally under the belief, so the
+    # expected value under the belief of the optimal value of each model is an upper bound
+    def upper_bound(self, belief, state, steps):
+        if not np.any(belief):
+            return BAMDP.upper_bound(self, belief, state, steps)
+
+        reward = np.asarray(self.reward, dtype=float)
+        while len(self._model_values) <= steps:
+            next_values = self._model_values[-1][:, self._successor_states]
+            contributions = self._successor_probabilities * (reward[self._successor_states] + self.discount * next_values)
+
+            # Sums over the successors of each (s, a)
+            totals = np.concatenate([np.zeros((len(self.models), 1)), np.cumsum(contributions, axis=1)], axis=1)
+            q = totals[:, self._successor_indptr[1:]] - totals[:, self._successor_indptr[:-1]]
+            self._model_values.append(q.reshape(len(self.models), self.n_states, self.n_actions).max(axis=2))
+
+        return belief @ self._model_values[steps][:, state]
+
+    def initial_belief(self, initial_distribution, state):
+        belief = initial_distribution[state] * np.asarray(self.prior, dtype=float)
+
+        c = np.sum(belief)
+        if np.allclose(c, 0):
+            return np.zeros(len(self.models))
+
+        return belief / c
+
+    def likelihoods(self, state, action, next_state):
+        i = state * self.n_actions + action
+        start, end = self._successor_indptr[i], self._successor_indptr[i + 1]
+
+        j = start + np.searchsorted(self._successor_states[start:end], next_state)
+        if j == end or self._successor_states[j] != next_state:
+            return np.zeros(len(self.models))
+
+        return self._successor_probabilities[:, j]
+
+    def update_belief(self, belief, state, action, next_state):
+        likelihoods = self.likelihoods(state, action, next_state)
+        if not self.informative[state, action] and likelihoods[0] > 0:
+            return belief
+
+        belief = belief * likelihoods
+
+        c = np.sum(belief)
         if np.allclose(c, 0):
+            return np.zeros(len(self.models))
+
+        return belief / c
+
+    def predictive(self, belief, states, actions):
+        if not np.any(belief):
+            posterior_probability = np.zeros(self.n_states)
             posterior_probability[0] = 1.
-        else:
-            for state in range(self.n_states):
-                for i, p in enumerate(self.models):
-                    posterior_probability[state] += probability_trajectory[i] * p(states[-1], actions[-1], state)
+            return posterior_probability
 
-            posterior_probability = posterior_probability / c
+        i = states[-1] * self.n_actions + actions[-1]
+        start, end = self._successor_indptr[i], self._successor_indptr[i + 1]
+
+        posterior_probability = np.zeros(self.n_states)
+        if self.informative[states[-1], actions[-1]]:
+            posterior_probability[self._successor_states[start:end]] = belief @ self._successor_probabilities[:, start:end]
+        else:
+            posterior_probability[self._successor_states[start:end]] = self._successor_probabilities[0, start:end]
 
         return posterior_probability
 
+    def predictive_successors(self, belief, states, actions):
+        if not np.any(belief):
+            return [0], [1.]
+
+        i = states[-1] * self.n_actions + actions[-1]
+        if i in self._shared_successors:
+            return self._shared_successors[i]
+
+        start, end = self._successor_indptr[i], self._successor_indptr[i + 1]
+        if not self.informative[states[-1], actions[-1]]:
+            nonzero = self._shared_nonzero[start:end]
+            self._shared_successors[i] = (self._successor_states[start:end][nonzero].tolist(),
+                                          self._successor_probabilities[0, start:end][nonzero].tolist())
+            return self._shared_successors[i]
+
+        probabilities = belief @ self._successor_probabilities[:, start:end]
+        nonzero = ~np.isclose(probabilities, 0)
+        return self._successor_states[start:end][nonzero].tolist(), probabilities[nonzero].tolist()
+
+    def hyperstate(self, initial_distribution, states, actions, belief=None):
+        if belief is None:
+            belief = self.belief(initial_distribution, states, actions)
+
+        return states[-1], len(states) - 1, np.round(belief, self.decimals).tobytes()
+
+    def posterior_predictive(self, initial_distribution, states, actions):
+        return self.predictive(self.belief(initial_distribution, states, actions), states, actions)
+
+    def posterior(self, initial_distribution, states, actions):
+        belief = self.belief(initial_distribution, states, actions)
+        if not np.any(belief):
+            belief = np.asarray(self.prior, dtype=float) / np.sum(self.prior)
+
+        return belief
+
+    def sample_posterior(self, posterior, random_state):
+        return self.models[random_state.choice(len(self.models), p=posterior)]
+
 
 class DirichletBAMDP(BAMDP):
     def __init__(self, alphas, reward, discount):
         BAMDP.__init__(self, alphas.shape[0], alphas.shape[1], reward, discount)
         self.alphas = alphas
 
+        # An (s, a) is informative unless its alphas are so large that a single observation leaves the predictive
+        # distribution unchanged, as for the known transitions built by alphas_from_models. The predictive
+        # distribution of the others is shared by every history, and their successors are listed when first needed.
+        totals = np.sum(alphas, axis=2)
+        self.informative = ~np.isclose(1. / np.where(totals > 0, totals, 1.), 0)
+
+        self._shared_predictive = alphas / np.where(totals > 0, totals, 1.)[:, :, np.newaxis]
+
+        # The non-zero alphas of each (s, a) in compressed sparse row order, from which models are drawn
+        rows, next_states = np.nonzero(alphas.reshape(-1, self.n_states))
+        self._alpha_indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=self.n_states * self.n_actions))])
+        self._alpha_states = next_states
+        self._alpha_values = alphas.reshape(-1, self.n_states)[rows, next_states].astype(float)
+        self._shared_successors = {}
+
+    def parameters(self):
+        return dict(BAMDP.parameters(self), alphas=np.asarray(self.alphas, dtype=float))
+
+    def hyperstate(self, initial_distribution, states, actions, belief=None):
+        # The posterior depends only on the current state and the counts of informative transitions
+        transitions = [(s, a, next_s) for s, a, next_s in zip(states[:-1], actions, states[1:]) if self.informative[s, a]]
+        return states[-1], len(states) - 1, tuple(sorted(transitions))
+
+    # Counts of the informative transitions in the history, indexed by s * n_actions + a
+    def posterior(self, initial_distribution, states, actions):
+        counts = {}
+        for s, a, next_s in zip(states[:-1], actions, states[1:]):
+            if self.informative[s, a]:
+                row = counts.setdefault(s * self.n_actions + a, collections.Counter())
+                row[next_s] += 1
+
+        return counts
+
+    def sample_posterior(self, posterior, random_state):
+        return DirichletModel(self, posterior, random_state)
+
     def posterior_predictive(self, initial_distribution, states, actions):
         posterior_probability = np.zeros(self.n_states)
 
         if np.allclose(initial_distribution[states[0]], 0):
             posterior_probability[0] = 1.
+        elif not self.informative[states[-1], actions[-1]]:
+            posterior_probability += self._shared_predictive[states[-1], actions[-1]]
         else:
             last_s, last_a = states[-1], actions[-1]
             posterior_probability += self.alphas[last_s, last_a]
@@ -159,3 +1487,102 @@ class DirichletBAMDP(BAMDP):
             posterior_probability = posterior_probability / np.sum(posterior_probability)
 
         return posterior_probability
+
+    def predictive_successors(self, belief, states, actions):
+        key = (states[-1], actions[-1])
+        if not self.informative[key] and not np.allclose(belief[states[0]], 0):
+            if key not in self._shared_successors:
+                next_states, probabilities = _nonzero(self._shared_predictive[key])
+                self._shared_successors[key] = (next_states.tolist(), probabilities.tolist())
+
+            return self._shared_successors[key]
+
+        return BAMDP.predictive_successors(self, belief, states, actions)
+
+
+class DirichletModel(Model):
+    # A model drawn from the posterior of a DirichletBAMDP given counts of informative transitions. The successors of
+    # each (s, a) are drawn when first needed, so that a model followed along a few histories costs a few draws rather
+    # than one per (s, a). Non-informative (s, a) keep their predictive distribution.
+    def __init__(self, bamdp, counts, random_state):
+        Model.__init__(self, bamdp.n_states, bamdp.n_actions)
+        self.bamdp = bamdp
+        self.counts = counts
+        self.random_state = random_state
+
+        self._rows = {}
+
+    def __call__(self, s, a, next_s):
+        next_states, probabilities = self.successors(s, a)
+        return float(np.sum(probabilities[next_states == next_s]))
+
+    def _alphas(self, i):
+        bamdp = self.bamdp
+        start, end = bamdp._alpha_indptr[i], bamdp._alpha_indptr[i + 1]
+        next_states, alphas = bamdp._alpha_states[start:end], bamdp._alpha_values[start:end]
+
+        if i in self.counts:
+            row = bamdp.alphas[i // self.n_actions, i % self.n_actions].astype(float)
+            for next_s, count in self.counts[i].items():
+                row[next_s] += count
+
+            next_states = np.flatnonzero(row)
+            alphas = row[next_states]
+
+        return next_states, alphas
+
+    def _draw(self, alphas, informative):
+        if not informative:
+            return alphas / np.sum(alphas)
+
+        # Normalized independent gamma variables are Dirichlet distributed
+        p = self.random_state.standard_gamma(alphas)
+        total = np.sum(p)
+        return p / total if total > 0 else alphas / np.sum(alphas)
+
+    def successors(self, s, a):
+        if self.successor_indptr is not None:
+            return Model.successors(self, s, a)
+
+        i = s * self.n_actions + a
+        if i not in self._rows:
+            next_states, alphas = self._alphas(i)
+            probabilities = self._draw(alphas, self.bamdp.informative[s, a])
+
+            nonzero = ~np.isclose(probabilities, 0)
+            self._rows[i] = next_states[nonzero], probabilities[nonzero]
+
+        return self._rows[i]
+
+    # Draws the successors of every (s, a) at once, keeping those already drawn
+    def sparse_transitions(self):
+        if self.successor_indptr is None:
+            bamdp = self.bamdp
+            for i in self.counts:
+                self.successors(i // self.n_actions, i % self.n_actions)
+
+            rows = _expand_rows(bamdp._alpha_indptr)
+            informative = bamdp.informative.reshape(-1)[rows]
+
+            p = bamdp._alpha_values.copy()
+            p[informative] = self.random_state.standard_gamma(p[informative])
+
+            n_rows = self.n_states * self.n_actions
+            totals = np.bincount(rows, weights=p, minlength=n_rows)
+            alpha_totals = np.bincount(rows, weights=bamdp._alpha_values, minlength=n_rows)
+            p = np.where(totals[rows] > 0, p / np.where(totals[rows] > 0, totals[rows], 1.), bamdp._alpha_values / alpha_totals[rows])
+
+            drawn = np.zeros(n_rows, dtype=bool)
+            drawn[list(self._rows)] = True
+            keep = ~drawn[rows]
+
+            rows, next_states, p = [rows[keep]], [bamdp._alpha_states[keep]], [p[keep]]
+            for i, (row_states, probabilities) in self._rows.items():
+                rows.append(np.full(len(row_states), i))
+                next_states.append(row_states)
+                p.append(probabilities)
+
+            self.successor_indptr, self.successor_states, self.successor_probabilities = \
+                _compress(np.concatenate(rows), np.concatenate(next_states), np.concatenate(p), n_rows, self.n_states)
+
+        return Model.sparse_transitions(self)
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from mtbrl.algorithms.bamdp import HistoryTree
+from mtbrl.algorithms.bamdp import PolicyTree
+
+
+class SolveCache:
+    # Solutions stored in a directory, one .npz file per problem and horizon, named after a hash of the problem
+    # parameters, the initial distribution and whether transpositions are used. Each file holds the action values as
+    # a PolicyTree. If extendable is True, the expanded history tree, whose first layers are shared by every longer
+    # horizon, is stored beside it in a .tree.npz file, which is usually much larger. When the files take more than
+    # max_bytes, history trees are deleted before action values, and the least recently used first. Several processes
+    # may share a directory: files are written under unique temporary names and renamed into place, and a file
+    # deleted by another process while it is being read counts as a miss.
+    def __init__(self, directory, max_bytes=2 ** 30, extendable=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extendable = extendable
+
+        self.hits = 0
+        self.misses = 0
+        self.extended = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, bamdp, initial_distribution, transpositions):
+        parameters = dict(bamdp.parameters(), initial_distribution=np.asarray(initial_distribution, dtype=float),
+                          transpositions=np.asarray(transpositions))
+
+        digest = hashlib.sha256(type(bamdp).__name__.encode())
+        for name in sorted(parameters):
+            array = np.ascontiguousarray(parameters[name])
+            digest.update(f'{name}:{array.dtype.str}:{array.shape}'.encode())
+            digest.update(array.tobytes())
+
+        return digest.hexdigest()
+
+    def path(self, key, horizon):
+        return os.path.join(self.directory, f'{key}-{horizon}.npz')
+
+    def tree_path(self, key, horizon):
+        return os.path.join(self.directory, f'{key}-{horizon}.tree.npz')
+
+    # Horizons whose action values are stored
+    def horizons(self, key):
+        horizons = []
+        for name in os.listdir(self.directory):
+            if name.startswith(f'{key}-') and name.endswith('.npz') and name[len(key) + 1:-len('.npz')].isdigit():
+                horizons.append(int(name[len(key) + 1:-len('.npz')]))
+
+        return sorted(horizons)
+
+    def solve(self, bamdp, initial_distribution, horizon, transpositions=False):
+        key = self.key(bamdp, initial_distribution, transpositions)
+
+        try:
+            policy_tree = self.load(key, horizon)
+        except FileNotFoundError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            return policy_tree
+
+        # The history tree of the longest shorter horizon still stored is expanded further rather than from scratch
+        tree = None
+        for shorter in reversed([h for h in self.horizons(key) if h < horizon]):
+            try:
+                tree = self.load_tree(key, shorter, initial_distribution, transpositions)
+            except FileNotFoundError:
+                continue
+
+            self.extended += 1
+            break
+
+        if tree is None:
+            tree = bamdp.expand(initial_distribution, 0, transpositions=transpositions)
+
+        while tree.horizon < horizon:
+            bamdp.expand_layer(tree)
+
+        policy_tree = PolicyTree.from_history_tree(tree, bamdp.backup(tree), bamdp.n_states, bamdp.n_actions)
+        self.store(key, horizon, policy_tree, tree)
+
+        return policy_tree
+
+    # The history tree is only stored if the cache is extendable
+    def store(self, key, horizon, policy_tree, tree=None):
+        arrays = {f'q_{name}': getattr(policy_tree, name) for name in PolicyTree.arrays}
+        arrays['n_states'] = np.array(policy_tree.n_states)
+
+        path = self.path(key, horizon)
+        self._write(path, arrays)
+        if tree is not None and self.extendable:
+            self._write(self.tree_path(key, horizon), self._tree_arrays(tree))
+
+        self.evict(keep=path)
+
+    def _tree_arrays(self, tree):
+        arrays = {}
+        arrays['layer_sizes'] = np.array([len(keys) for keys in tree.keys], dtype=int)
+        arrays['roots'], arrays['root_probabilities'] = tree.roots, tree.root_probabilities
+        arrays['root_states'] = np.array([states[0] for states, _ in tree.histories[0]], dtype=int)
+
+        names = ['edge_nodes', 'edge_actions', 'edge_states', 'edge_probabilities', 'edge_children']
+        for i, name in enumerate(names):
+            arrays[name] = np.concatenate([edges[i] for edges in tree.edges]) if tree.edges else np.zeros(0)
+        arrays['edge_counts'] = np.array([len(edges[0]) for edges in tree.edges], dtype=int)
+
+        # Only the last layer is needed to expand the tree further
+        n_frontier = len(tree.histories[-1])
+        arrays['frontier_states'] = np.array([states for states, _ in tree.histories[-1]], dtype=int).reshape(n_frontier, -1)
+        arrays['frontier_actions'] = np.array([actions for _, actions in tree.histories[-1]], dtype=int).reshape(n_frontier, -1)
+        arrays['frontier_beliefs'] = np.array(tree.beliefs[-1])
+
+        return arrays
+
+    def _write(self, path, arrays):
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp.npz', dir=self.directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def load(self, key, horizon):
+        path = self.path(key, horizon)
+        os.utime(path)
+
+        with np.load(path) as arrays:
+            return PolicyTree(int(arrays['n_states']), **{name: arrays[f'q_{name}'] for name in PolicyTree.arrays})
+
+    # In the restored history tree, only the first and last layers keep their histories
+    def load_tree(self, key, horizon, initial_distribution, transpositions):
+        path = self.tree_path(key, horizon)
+        os.utime(path)
+
+        tree = HistoryTree(initial_distribution, horizon, transpositions=transpositions)
+        with np.load(path) as arrays:
+            tree.roots, tree.root_probabilities = arrays['roots'], arrays['root_probabilities']
+
+            layer_sizes = arrays['layer_sizes']
+            tree.keys = [[None] * size for size in layer_sizes]
+            tree.histories = [[None] * size for size in layer_sizes]
+            tree.beliefs = [[None] * size for size in layer_sizes]
+
+            offsets = np.cumsum(np.concatenate([[0], arrays['edge_counts']]))
+            names = ['edge_nodes', 'edge_actions', 'edge_states', 'edge_probabilities', 'edge_children']
+            tree.edges = [tuple(arrays[name][start:end] for name in names) for start, end in zip(offsets[:-1], offsets[1:])]
+
+            tree.histories[0] = [((int(state),), ()) for state in arrays['root_states']]
+            tree.histories[-1] = [(tuple(states), tuple(actions)) for states, actions in
+                                  zip(arrays['frontier_states'].tolist(), arrays['frontier_actions'].tolist())]
+            tree.beliefs[-1] = list(arrays['frontier_beliefs'])
+
+        return tree
+
+    # The file at keep is never deleted, so the files may still take more than max_bytes if it alone does
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                entries.append((not name.endswith('.tree.npz'), status.st_mtime, status.st_size, path))
+
+        total = sum(size for _, _, size, _ in entries)
+        for _, _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            if path != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+                total -= size
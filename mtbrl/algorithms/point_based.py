@@ -0,0 +1,191 @@
+import numpy as np
+
+from mtbrl.algorithms.bamdp import Policy
+from mtbrl.algorithms.bamdp import PolicyCursor
+
+
+class PointBasedPolicy(Policy):
+    # Point-based value iteration (Pineau et al., 2003) for a CountableBAMDP with a discount below one. The value of a
+    # hyperstate (s, belief) is approximated by the maximum of belief @ alpha over the alpha vectors of s, which are
+    # backed up at n_points beliefs reached by acting at random for max_depth steps in models drawn from the prior.
+    # Iterations stop once no value at a belief point changes by more than epsilon, or after n_iterations. If n_steps
+    # is not None, no action is chosen after n_steps steps.
+    def __init__(self, bamdp, initial_distribution, n_points=1000, max_depth=None, n_iterations=1000, epsilon=1e-6,
+                 n_steps=None, seed=None):
+        if bamdp.discount >= 1:
+            raise ValueError('Point-based value iteration requires a discount below one.')
+
+        self.bamdp = bamdp
+        self.initial_distribution = initial_distribution
+        self.n_steps = n_steps
+        self.random_state = np.random.RandomState(seed)
+
+        if max_depth is None:
+            max_depth = bamdp.effective_horizon(epsilon)
+
+        self.point_states, self.point_beliefs = self.sample_beliefs(n_points, max_depth)
+
+        # Alpha vectors, one per row, sorted by state. Every state keeps a lower bound on its value, so that each
+        # successor has at least one alpha vector.
+        lower_bound = np.min(bamdp.reward) / (1 - bamdp.discount)
+        self.alpha_states = np.arange(bamdp.n_states)
+        self.alpha_actions = np.zeros(bamdp.n_states, dtype=int)
+        self.alphas = np.full((bamdp.n_states, len(bamdp.models)), lower_bound)
+        self._index()
+
+        self.n_iterations = 0
+        values = self.values(self.point_states, self.point_beliefs)
+        while self.n_iterations < n_iterations:
+            self.backup()
+            self.n_iterations += 1
+
+            next_values = self.values(self.point_states, self.point_beliefs)
+            if np.max(np.abs(next_values - values)) <= epsilon:
+                break
+            values = next_values
+
+        self._policy = {}
+
+    def sample_beliefs(self, n_points, max_depth):
+        bamdp = self.bamdp
+        initial_states = np.flatnonzero(~np.isclose(self.initial_distribution, 0))
+
+        points = {}
+        for state in initial_states.tolist():
+            belief = bamdp.initial_belief(self.initial_distribution, state)
+            points.setdefault((state, np.round(belief, bamdp.decimals).tobytes()), (state, belief))
+
+        # Trajectories stop when no new belief point is found for many consecutive trajectories
+        unproductive = 0
+        while len(points) < n_points and unproductive < 100:
+            state = int(self.random_state.choice(bamdp.n_states, p=self.initial_distribution))
+            belief = bamdp.initial_belief(self.initial_distribution, state)
+            model = bamdp.models[self.random_state.choice(len(bamdp.models), p=belief)]
+
+            n_points_before = len(points)
+            for _ in range(max_depth):
+                action = self.random_state.randint(bamdp.n_actions)
+                next_states, probabilities = model.successors(state, action)
+                next_state = int(next_states[self.random_state.choice(len(next_states), p=probabilities / np.sum(probabilities))])
+
+                belief = bamdp.update_belief(belief, state, action, next_state)
+                state = next_state
+
+                points.setdefault((state, np.round(belief, bamdp.decimals).tobytes()), (state, belief))
+                if len(points) >= n_points:
+                    break
+
+            unproductive = 0 if len(points) > n_points_before else unproductive + 1
+
+        point_states = np.array([state for state, _ in points.values()], dtype=int)
+        point_beliefs = np.array([belief for _, belief in points.values()])
+        return point_states, point_beliefs
+
+    def _index(self):
+        order = np.argsort(self.alpha_states, kind='stable')
+        self.alpha_states, self.alpha_actions, self.alphas = self.alpha_states[order], self.alpha_actions[order], self.alphas[order]
+        self.alpha_indptr = np.concatenate([[0], np.cumsum(np.bincount(self.alpha_states, minlength=self.bamdp.n_states))])
+
+    # Index of the best alpha vector of each state for each (unnormalized) belief
+    def best_alphas(self, states, beliefs):
+        counts = np.diff(self.alpha_indptr)[states]
+        pairs = np.repeat(np.arange(len(states)), counts)
+        offsets = np.arange(len(pairs)) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = self.alpha_indptr[states][pairs] + offsets
+
+        scores = np.sum(self.alphas[candidates] * beliefs[pairs], axis=1)
+
+        # The first candidate of each pair with the maximum score
+        order = np.lexsort((-scores, pairs))
+        return candidates[order[np.cumsum(counts) - counts]]
+
+    def values(self, states, beliefs):
+        return np.sum(self.alphas[self.best_alphas(states, beliefs)] * beliefs, axis=1)
+
+    def backup(self):
+        bamdp = self.bamdp
+        indptr, successor_states, successor_probabilities = \
+            bamdp._successor_indptr, bamdp._successor_states, bamdp._successor_probabilities
+
+        n_points, n_models = self.point_beliefs.shape
+        q = np.zeros((n_points, bamdp.n_actions))
+        alphas = np.zeros((n_points, bamdp.n_actions, n_models))
+        for action in range(bamdp.n_actions):
+            rows = self.point_states * bamdp.n_actions + action
+            counts = indptr[rows + 1] - indptr[rows]
+
+            # Every (point, successor) pair under the stacked models
+            pairs = np.repeat(np.arange(n_points), counts)
+            columns = np.repeat(indptr[rows], counts) + np.arange(len(pairs)) - np.repeat(np.cumsum(counts) - counts, counts)
+            next_states = successor_states[columns]
+            probabilities = successor_probabilities[:, columns].T
+
+            # The posterior after each successor is proportional to belief * probability
+            best = self.best_alphas(next_states, self.point_beliefs[pairs] * probabilities)
+            contributions = probabilities * (np.asarray(bamdp.reward)[next_states, np.newaxis] + bamdp.discount * self.alphas[best])
+
+            np.add.at(alphas[:, action], pairs, contributions)
+            q[:, action] = np.sum(alphas[:, action] * self.point_beliefs, axis=1)
+
+        actions = np.argmax(q, axis=1)
+        new_alphas = alphas[np.arange(n_points), actions]
+
+        # Points that share a state and a backed up alpha vector need it only once
+        _, unique = np.unique(np.column_stack([self.point_states, actions, new_alphas]), axis=0, return_index=True)
+
+        self.alpha_states = np.concatenate([np.arange(bamdp.n_states), self.point_states[unique]])
+        self.alpha_actions = np.concatenate([np.zeros(bamdp.n_states, dtype=int), actions[unique]])
+        self.alphas = np.concatenate([self.alphas[self.alpha_indptr[:-1]], new_alphas[unique]])
+        self._index()
+
+    def action(self, state, belief):
+        return int(self.alpha_actions[self.best_alphas(np.array([state]), belief[np.newaxis])[0]])
+
+    def value(self, state, belief):
+        return float(self.values(np.array([state]), belief[np.newaxis])[0])
+
+    def __getitem__(self, states):
+        if self.n_steps is not None and len(states) - 1 >= self.n_steps:
+            raise IndexError(states)
+
+        if states not in self._policy:
+            if len(states) == 1:
+                belief = self.bamdp.initial_belief(self.initial_distribution, states[0])
+            else:
+                action = self[states[:-1]]
+                belief = self.bamdp.update_belief(self._policy[states[:-1]][1], states[-2], action, states[-1])
+
+            self._policy[states] = (self.action(states[-1], belief), belief)
+
+        return self._policy[states][0]
+
+    def cursor(self):
+        return PointBasedCursor(self)
+
+
+class PointBasedCursor(PolicyCursor):
+    # Updates the belief after each observation instead of looking up the history
+    def __init__(self, policy):
+        PolicyCursor.__init__(self, policy)
+        self.belief = None
+        self.last_action = None
+
+    def reset(self, state):
+        if self.policy.n_steps is not None and self.policy.n_steps <= 0:
+            raise IndexError(state)
+
+        self.states = [state]
+        self.belief = self.policy.bamdp.initial_belief(self.policy.initial_distribution, state)
+
+        self.last_action = self.policy.action(state, self.belief)
+        return self.last_action
+
+    def step(self, next_state):
+        if self.policy.n_steps is not None and len(self.states) >= self.policy.n_steps:
+            raise IndexError(next_state)
+
+        self.belief = self.policy.bamdp.update_belief(self.belief, self.states[-1], self.last_action, next_state)
+        self.states.append(next_state)
+
+        self.last_action = self.policy.action(next_state, self.belief)
+        return self.last_action
@@ -0,0 +1,81 @@
+import numpy as np
+
+from mtbrl.algorithms.bamdp import Policy
+from mtbrl.algorithms.bamdp import PolicyCursor
+
+
+class RecedingHorizonPolicy(Policy):
+    # Chooses each action by solving the history tree of the following horizon steps. If n_steps is not None, no
+    # action is chosen after n_steps steps.
+    def __init__(self, bamdp, initial_distribution, horizon, transpositions=False, n_steps=None):
+        self.bamdp = bamdp
+        self.initial_distribution = initial_distribution
+        self.horizon = horizon
+        self.transpositions = transpositions
+        self.n_steps = n_steps
+
+        self._policy = {}
+
+    def __getitem__(self, states):
+        if self.n_steps is not None and len(states) - 1 >= self.n_steps:
+            raise IndexError(states)
+
+        if states not in self._policy:
+            actions = tuple([self[states[:t]] for t in range(1, len(states))])
+            tree = self.bamdp.history_tree(self.initial_distribution, states, actions, self.transpositions)
+            self._policy[states] = self.plan(tree)
+
+        return self._policy[states]
+
+    def plan(self, tree):
+        while tree.horizon < self.horizon:
+            self.bamdp.expand_layer(tree)
+
+        return int(np.argmax(self.bamdp.backup(tree)[0][0]))
+
+    def cursor(self):
+        return RecedingHorizonCursor(self)
+
+
+class RecedingHorizonCursor(PolicyCursor):
+    # Keeps the tree planned at the previous step. After each observation, only the subtree below the observed branch
+    # is kept and a single layer is added to it. If the BAMDP has sufficient beliefs, the histories in the tree start
+    # at its root, so that a step costs the same however many steps came before. Otherwise, every node holds its whole
+    # history, and the cost of a step grows linearly with the number of steps taken.
+    def __init__(self, policy):
+        PolicyCursor.__init__(self, policy)
+        self.actions = []
+        self.tree = None
+
+    def reset(self, state):
+        if self.policy.n_steps is not None and self.policy.n_steps <= 0:
+            raise IndexError(state)
+
+        self.states, self.actions = [state], []
+        self.tree = self.policy.bamdp.history_tree(self.policy.initial_distribution, self.states, self.actions,
+                                                   self.policy.transpositions)
+
+        self.actions.append(self.policy.plan(self.tree))
+        return self.actions[-1]
+
+    def step(self, next_state):
+        if self.policy.n_steps is not None and len(self.states) >= self.policy.n_steps:
+            raise IndexError(next_state)
+
+        _, actions, states, _, children = self.tree.edges[0]
+        edges = np.flatnonzero((actions == self.actions[-1]) & (states == next_state))
+
+        bamdp = self.policy.bamdp
+        self.states.append(next_state)
+        if len(edges) > 0:
+            self.tree = self.tree.subtree(children[edges[0]], relative=bamdp.sufficient_beliefs)
+        elif bamdp.sufficient_beliefs:
+            belief = bamdp.update_belief(self.tree.beliefs[0][0], self.states[-2], self.actions[-1], next_state)
+            self.tree = bamdp.history_tree(self.policy.initial_distribution, [next_state], [],
+                                           self.policy.transpositions, belief)
+        else:
+            self.tree = bamdp.history_tree(self.policy.initial_distribution, self.states, self.actions,
+                                           self.policy.transpositions)
+
+        self.actions.append(self.policy.plan(self.tree))
+        return self.actions[-1]
@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import collections
+import json
+import numbers
+import time
+
+import numpy as np
+
+from mtbrl.algorithms.bamdp import OptimalPolicy
+from mtbrl.algorithms.bamdp import PolicyTree
+
+
+class DecisionServer:
+    # Chooses actions for (problem id, history) requests. Requests for the same problem that arrive while a batch is
+    # being decided are decided together, at most max_batch_size at a time, by one call to Policy.batch_actions per
+    # history length. Latencies of the last n_latencies decisions are kept for reports.
+    def __init__(self, policies=None, max_batch_size=1024, n_latencies=100000):
+        self.policies = dict(policies or {})
+        self.n_states = {}
+        self.max_batch_size = max_batch_size
+
+        self._queues = {}
+        self._workers = {}
+        self._closed = False
+
+        self.n_decisions = 0
+        self.n_batches = 0
+        self.latencies = collections.deque(maxlen=n_latencies)
+        self._start = None
+
+    # If n_states is not None, requests with states outside range(n_states) are refused before they are decided
+    def add(self, problem, policy, n_states=None):
+        self.policies[problem] = policy
+        self.n_states[problem] = n_states
+
+    # Loads a PolicyTree saved to a directory. Its arrays are memory-mapped, so that every server process that loads
+    # the same directory shares a single copy in the page cache.
+    def load(self, problem, path, cache_size=1024):
+        tree = PolicyTree.load(path, mmap_mode='r')
+        self.add(problem, OptimalPolicy(tree, cache_size=cache_size), tree.n_states)
+
+    async def decide(self, problem, states):
+        if self._closed:
+            raise RuntimeError('The server is closed.')
+
+        if problem not in self.policies:
+            raise KeyError(problem)
+
+        n_states = self.n_states.get(problem)
+        if not isinstance(states, (list, tuple, np.ndarray)) or len(states) == 0 or \
+                not all(isinstance(state, numbers.Integral) and not isinstance(state, bool) for state in states):
+            raise ValueError(f'States must be a non-empty list of integers: {states!r}')
+
+        states = [int(state) for state in states]
+        if any(state < 0 or state >= (n_states if n_states is not None else 2 ** 63) for state in states):
+            raise ValueError(f'States out of range: {states!r}')
+
+        if problem not in self._workers:
+            self._queues[problem] = asyncio.Queue()
+            self._workers[problem] = asyncio.get_running_loop().create_task(self._serve_problem(problem))
+
+        if self._start is None:
+            self._start = time.perf_counter()
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues[problem].put_nowait((tuple(states), future, time.perf_counter()))
+        return await future
+
+    async def _serve_problem(self, problem):
+        queue = self._queues[problem]
+        while True:
+            requests = [await queue.get()]
+            while len(requests) < self.max_batch_size and not queue.empty():
+                requests.append(queue.get_nowait())
+
+            # A batch that cannot be decided fails its own requests, and the next batch is decided as usual
+            try:
+                results = self.batch_decide(problem, [states for states, _, _ in requests])
+            except Exception as e:
+                results = [e] * len(requests)
+
+            end = time.perf_counter()
+            for (_, future, start), result in zip(requests, results):
+                if future.cancelled():
+                    continue
+
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+                    self.latencies.append(end - start)
+
+            self.n_decisions += len(requests)
+            self.n_batches += 1
+
+            # Lets the clients whose requests were decided send their next requests before the next batch
+            await asyncio.sleep(0)
+
+    # Stops deciding. Requests still queued fail with a RuntimeError, and later requests are refused.
+    async def close(self):
+        self._closed = True
+
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        for queue in self._queues.values():
+            while not queue.empty():
+                _, future, _ = queue.get_nowait()
+                if not future.done():
+                    future.set_exception(RuntimeError('The server is closed.'))
+
+        self._queues.clear()
+        self._workers.clear()
+
+    # Actions, or the exceptions raised while choosing them, for a list of histories of a problem
+    def batch_decide(self, problem, histories):
+        policy = self.policies[problem]
+
+        by_length = collections.defaultdict(list)
+        for i, states in enumerate(histories):
+            by_length[len(states)].append(i)
+
+        results = [None] * len(histories)
+        for length, indices in by_length.items():
+            try:
+                actions = policy.batch_actions(np.array([histories[i] for i in indices], dtype=int).reshape(len(indices), length))
+                for i, action in zip(indices, actions.tolist()):
+                    results[i] = action
+            except Exception:
+                # The failing histories are found by deciding them one at a time
+                for i in indices:
+                    try:
+                        results[i] = int(policy[histories[i]])
+                    except Exception as e:
+                        results[i] = e
+
+        return results
+
+    def report(self):
+        elapsed = time.perf_counter() - self._start if self._start is not None else 0.
+        latencies = np.array(self.latencies) * 1e3
+
+        report = {'decisions': self.n_decisions,
+                  'batches': self.n_batches,
+                  'mean_batch_size': self.n_decisions / self.n_batches if self.n_batches > 0 else None,
+                  'decisions_per_second': self.n_decisions / elapsed if elapsed > 0 else None}
+        for percentile in [50, 90, 99]:
+            report[f'latency_p{percentile}_ms'] = float(np.percentile(latencies, percentile)) if len(latencies) > 0 else None
+
+        return report
+
+    # Serves newline-delimited JSON requests {"problem": ..., "states": [...]} on a local socket. Each request is
+    # answered by {"action": ...} or {"error": ...}, in order, and {"report": true} is answered by the report.
+    async def serve(self, host='127.0.0.1', port=0):
+        return await asyncio.start_server(self._handle, host, port)
+
+    # Malformed requests, as well as requests that cannot be decided, are answered by an error
+    async def _answer(self, line):
+        try:
+            request = json.loads(line)
+            if request.get('report'):
+                return {'report': self.report()}
+
+            return {'action': await self.decide(request['problem'], request['states'])}
+        except Exception as e:
+            return {'error': repr(e)}
+
+    async def _handle(self, reader, writer):
+        # Requests on the same connection are decided concurrently and answered in order
+        responses = asyncio.Queue()
+
+        async def respond():
+            while (response := await responses.get()) is not None:
+                writer.write((json.dumps(await response) + '\n').encode())
+                await writer.drain()
+
+        responder = asyncio.ensure_future(respond())
+        while line := await reader.readline():
+            responses.put_nowait(asyncio.ensure_future(self._answer(line)))
+
+        responses.put_nowait(None)
+        await responder
+
+        writer.close()
+        await writer.wait_closed()
+
+
+class DecisionClient:
+    # Sends requests to a DecisionServer over a local socket. Concurrent decisions share the connection.
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._pending = collections.deque()
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=0):
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def _request(self, request):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self.writer.write((json.dumps(request) + '\n').encode())
+        await self.writer.drain()
+
+        # Responses arrive in order, so whoever holds the lock reads until its own response is in
+        async with self._lock:
+            while not future.done():
+                self._pending.popleft().set_result(json.loads(await self.reader.readline()))
+
+        return future.result()
+
+    async def decide(self, problem, states):
+        response = await self._request({'problem': problem, 'states': [int(state) for state in states]})
+        if 'error' in response:
+            raise LookupError(response['error'])
+
+        return response['action']
+
+    async def report(self):
+        return (await self._request({'report': True}))['report']
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves actions of saved policy trees on a local socket.')
+    parser.add_argument('policies', nargs='+', help='Problems as id=path, where path is a directory saved by PolicyTree.save.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch-size', type=int, default=1024)
+    args = parser.parse_args()
+
+    server = DecisionServer(max_batch_size=args.max_batch_size)
+    for policy in args.policies:
+        problem, path = policy.split('=', 1)
+        server.load(problem, path)
+
+    async def serve():
+        try:
+            async with await server.serve(args.host, args.port) as s:
+                await s.serve_forever()
+        finally:
+            await server.close()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import json
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mtbrl.algorithms.bamdp import CountableBAMDP
+
+from mtbrl.benchmarks.scaling import families
+
+
+# Expected discounted return over horizon steps of an optimal policy for a known model
+def optimal_return(model, initial_distribution, reward, discount, horizon):
+    indptr, next_states, probabilities = model.sparse_transitions()
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    reward = np.asarray(reward, dtype=float)
+
+    v = np.zeros(model.n_states)
+    for _ in range(horizon):
+        q = np.bincount(rows, weights=probabilities * (reward + discount * v)[next_states], minlength=len(indptr) - 1)
+        v = np.max(q.reshape(model.n_states, model.n_actions), axis=1)
+
+    return float(initial_distribution @ v)
+
+
+# Discounted returns of n_episodes episodes of a policy in a model. Seeds are derived from seed and the cell, so that
+# results do not depend on how cells are distributed among processes.
+def episode_returns(model, initial_distribution, reward, discount, policy, horizon, n_episodes, seed):
+    _, rewards = model.simulate_batch(initial_distribution, reward, policy, n_episodes, horizon, seed=seed)
+    return rewards @ (discount ** np.arange(horizon))
+
+
+# Each worker process receives the problem once, when it starts, rather than once per cell
+_worker_problem = None
+
+
+def _initialize_worker(problem):
+    global _worker_problem
+    _worker_problem = problem
+
+
+def _cell_returns(i, j, horizon, n_episodes, seed):
+    bamdp, initial_distribution, policies = _worker_problem
+    return episode_returns(bamdp.models[j], initial_distribution, bamdp.reward, bamdp.discount, policies[i], horizon,
+                           n_episodes, seed)
+
+
+# Runs every policy against every model of a CountableBAMDP for n_episodes episodes each. Returns a dict of arrays:
+# returns (n_policies, n_models, n_episodes), optimal_returns (n_models), regret (n_policies, n_models), the expected
+# regret in each model, and bayes_regret (n_policies), its expectation under the prior, with their standard errors.
+def evaluate(bamdp, initial_distribution, policies, horizon, n_episodes=1000, n_jobs=1, seed=0):
+    cells = [(i, j, horizon, n_episodes, seed + i * len(bamdp.models) + j)
+             for i in range(len(policies)) for j in range(len(bamdp.models))]
+
+    returns = np.zeros((len(policies), len(bamdp.models), n_episodes))
+    if n_jobs == 1:
+        _initialize_worker((bamdp, initial_distribution, policies))
+        for cell in cells:
+            returns[cell[:2]] = _cell_returns(*cell)
+        _initialize_worker(None)
+    else:
+        with ProcessPoolExecutor(n_jobs, initializer=_initialize_worker,
+                                 initargs=((bamdp, initial_distribution, policies),)) as executor:
+            futures = [(cell[:2], executor.submit(_cell_returns, *cell)) for cell in cells]
+            for index, future in futures:
+                returns[index] = future.result()
+
+    optimal_returns = np.array([optimal_return(model, initial_distribution, bamdp.reward, bamdp.discount, horizon)
+                                for model in bamdp.models])
+    prior = np.asarray(bamdp.prior, dtype=float) / np.sum(bamdp.prior)
+
+    regret = optimal_returns - np.mean(returns, axis=2)
+    regret_error = np.std(returns, axis=2, ddof=1) / np.sqrt(n_episodes) if n_episodes > 1 else np.zeros_like(regret)
+
+    return {'returns': returns,
+            'optimal_returns': optimal_returns,
+            'regret': regret,
+            'regret_error': regret_error,
+            'bayes_regret': regret @ prior,
+            'bayes_regret_error': np.sqrt(regret_error ** 2 @ prior ** 2),
+            'percentiles': np.percentile(returns, [5, 25, 50, 75, 95], axis=2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the regret of policies against every candidate model.')
+    parser.add_argument('family', choices=sorted(families), help='Problem family, as in mtbrl.benchmarks.scaling.')
+    parser.add_argument('--params', default='{}', help='Parameters of the family, as a JSON object.')
+    parser.add_argument('--horizon', type=int, default=4)
+    parser.add_argument('--episodes', type=int, default=1000, help='Number of episodes for each policy and model.')
+    parser.add_argument('--discount', type=float, default=0.99)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='regret.npz', help='Path of the .npz file of results.')
+    args = parser.parse_args()
+
+    models, initial_distribution, reward, fixed_policy = families[args.family](**json.loads(args.params))
+    bamdp = CountableBAMDP(models, np.ones(len(models)) / len(models), reward, discount=args.discount)
+
+    names = ['fixed', 'bayes_optimal']
+    policies = [fixed_policy, bamdp.solve(initial_distribution, args.horizon, compact=True)]
+
+    start = time.perf_counter()
+    results = evaluate(bamdp, initial_distribution, policies, args.horizon, args.episodes, args.jobs, args.seed)
+    print(f'# {len(policies)} policies x {len(models)} models x {args.episodes} episodes in '
+          f'{time.perf_counter() - start:.2f}s', file=sys.stderr)
+
+    for name, bayes_regret, error in zip(names, results['bayes_regret'], results['bayes_regret_error']):
+        print(f'{name}: Bayes regret {bayes_regret:.4f} +/- {error:.4f}', file=sys.stderr)
+
+    np.savez(args.output, policies=np.array(names), **results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from mtbrl.environments.bernoulli_bandits import create_bernoulli_bandits
+from mtbrl.environments.bernoulli_bandits import FixedPolicy as FixedPolicyBB
+
+from mtbrl.environments.gridworld import create_gridworld
+from mtbrl.environments.gridworld import FixedPolicy as FixedPolicyGW
+
+from mtbrl.algorithms.bamdp import CountableBAMDP
+from mtbrl.algorithms.bamdp import DirichletBAMDP
+
+from mtbrl.examples.dirichlet import alphas_from_models
+
+
+def bandits(n_arms, n_models):
+    models = []
+    for i in range(n_models):
+        success_probabilities = np.zeros(n_arms)
+        success_probabilities[i % n_arms] = 1.
+        models.append(create_bernoulli_bandits(success_probabilities))
+
+    _, initial_distribution, reward = models[0]
+    return [model for model, _, _ in models], initial_distribution, reward, FixedPolicyBB([1] * 1000)
+
+
+def corridors(length, slip, n_models):
+    models = []
+    for i in range(n_models):
+        char_matrix = ['.'] * length
+        char_matrix[1] = '&'
+        char_matrix[0 if i % 2 else length - 1] = '$'
+        models.append(create_gridworld([char_matrix], slip))
+
+    _, initial_distribution, reward = models[0]
+    return [model for model, _, _ in models], initial_distribution, reward, FixedPolicyGW('d' * 1000)
+
+
+def gridworlds(size, slip, n_models):
+    goals = [(size - 1, size - 1), (size - 1, 0), (0, size - 1)]
+
+    models = []
+    for i in range(n_models):
+        char_matrix = np.full((size, size), '.')
+        char_matrix[0, 0] = '&'
+        char_matrix[size // 2, size // 2] = '#'
+        char_matrix[goals[i % len(goals)]] = '$'
+        models.append(create_gridworld(char_matrix, slip))
+
+    _, initial_distribution, reward = models[0]
+    return [model for model, _, _ in models], initial_distribution, reward, FixedPolicyGW('ds' * 500)
+
+
+families = {'bandits': bandits, 'corridors': corridors, 'gridworlds': gridworlds}
+
+cases = [('bandits', {'n_arms': 2, 'n_models': 2}, [4, 6, 7]),
+         ('bandits', {'n_arms': 4, 'n_models': 4}, [3, 4]),
+         ('corridors', {'length': 6, 'slip': 0., 'n_models': 2}, [4, 5, 6]),
+         ('corridors', {'length': 6, 'slip': 0.1, 'n_models': 2}, [2, 3]),
+         ('corridors', {'length': 12, 'slip': 0., 'n_models': 4}, [4, 5]),
+         ('gridworlds', {'size': 3, 'slip': 0., 'n_models': 3}, [3, 4]),
+         ('gridworlds', {'size': 3, 'slip': 0.1, 'n_models': 2}, [2]),
+         ('gridworlds', {'size': 8, 'slip': 0., 'n_models': 3}, [2, 3])]
+
+quick_cases = [(family, params, horizons[:1]) for family, params, horizons in cases]
+
+
+# Tracing allocations slows the function down, so its peak memory is measured in a second run, unless memory is False
+def measure(bamdp, function, memory=True):
+    stats = bamdp.instrument()
+    start = time.perf_counter()
+    result = function()
+    wall_time = time.perf_counter() - start
+    bamdp.stats = None
+
+    peak_memory = None
+    if memory:
+        tracemalloc.start()
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    nodes = sum(stats.nodes.values())
+    return result, {'wall_time': wall_time,
+                    'nodes': nodes,
+                    'nodes_per_second': nodes / wall_time if wall_time > 0 else None,
+                    'peak_memory': peak_memory,
+                    'hit_rate': stats.hit_rate()}
+
+
+def run_case(family, params, horizon, transpositions, n_rollouts, memory=True):
+    models, initial_distribution, reward, fixed_policy = families[family](**params)
+
+    bamdps = {'countable': CountableBAMDP(models, np.ones(len(models)) / len(models), reward, discount=0.99),
+              'dirichlet': DirichletBAMDP(alphas_from_models(models), reward, discount=0.99)}
+
+    results, policies = [], {}
+    for kind, bamdp in bamdps.items():
+        case = {'family': family, 'params': params, 'horizon': horizon, 'bamdp': kind, 'transpositions': transpositions}
+
+        policy, solve = measure(bamdp, lambda: bamdp.solve(initial_distribution, horizon, transpositions=transpositions), memory)
+        solve['q_star_size'] = len(policy.q_star)
+        policies[kind] = policy
+        results.append(dict(case, method='solve', **solve))
+
+        value, evaluation = measure(bamdp, lambda: bamdp.value(initial_distribution, policy, horizon,
+                                                               transpositions=transpositions), memory)
+        results.append(dict(case, method='value', value=value, **evaluation))
+
+        value, evaluation = measure(bamdp, lambda: bamdp.value(initial_distribution, fixed_policy, horizon), memory)
+        results.append(dict(case, method='value_fixed', value=value, **evaluation))
+
+    # Simulation only depends on the model and the policy, which is the solution of each BAMDP in turn
+    for kind, policy in policies.items():
+        start = time.perf_counter()
+        for seed in range(n_rollouts):
+            models[0].simulate(initial_distribution, reward, policy, render=False, seed=seed)
+        wall_time = time.perf_counter() - start
+        results.append({'family': family, 'params': params, 'horizon': horizon, 'method': 'simulate', 'policy': kind,
+                        'rollouts': n_rollouts, 'wall_time': wall_time, 'steps_per_second': n_rollouts * horizon / wall_time})
+
+    start = time.perf_counter()
+    models[0].simulate_batch(initial_distribution, reward, fixed_policy, 100 * n_rollouts, horizon, seed=0)
+    wall_time = time.perf_counter() - start
+    results.append({'family': family, 'params': params, 'horizon': horizon, 'method': 'simulate_batch',
+                    'rollouts': 100 * n_rollouts, 'wall_time': wall_time,
+                    'steps_per_second': 100 * n_rollouts * horizon / wall_time})
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures how solving, evaluation and simulation scale.')
+    parser.add_argument('--output', help='Path of the JSON report. The report is printed if omitted.')
+    parser.add_argument('--quick', action='store_true', help='Only run the smallest horizon of each case.')
+    parser.add_argument('--transpositions', action='store_true', help='Solve and evaluate with transpositions.')
+    parser.add_argument('--rollouts', type=int, default=100, help='Number of rollouts for simulation benchmarks.')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the second run of each solve and evaluation that measures its peak memory.')
+    args = parser.parse_args()
+
+    results = []
+    for family, params, horizons in (quick_cases if args.quick else cases):
+        for horizon in horizons:
+            print(f'# {family} {params} horizon={horizon}', file=sys.stderr)
+            results.extend(run_case(family, params, horizon, args.transpositions, args.rollouts, not args.no_memory))
+
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+              'peak_memory': None if args.no_memory else 'measured in a second run of each solve and evaluation',
+              'results': results}
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,8 @@ class BernoulliBandits(Model):
             self._p[:, action, self.reward_state] = self.success_probabilities[action]
             self._p[:, action, self.no_reward_state] = 1 - self.success_probabilities[action]
 
+        self.compress(self._p)
+
     def __call__(self, s, a, next_s):
         return self._p[s, a, next_s]
 
@@ -31,6 +33,9 @@ class FixedPolicy(Policy):
     def __getitem__(self, states):
         return self.actions[len(states) - 1] - 1
 
+    def batch_actions(self, states):
+        return np.full(len(states), self.actions[states.shape[1] - 1] - 1)
+
 
 class InteractivePolicy(Policy):
     def __getitem__(self, states):
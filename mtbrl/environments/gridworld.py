@@ -17,34 +17,41 @@ class GridWorld(Model):
         layout_flat = self.layout.reshape(-1)
 
         # up, left, down, right
-        actions = [(-1, 0), (0, -1), (1, 0), (0, 1)]
-
-        self._p = np.zeros((self.n_states, self.n_actions, self.n_states))
-
-        for s in range(self.n_states):
-            if (s == self.trap_state) or (s == self.goal_state):
-                self._p[s, :, s] = 1.0
-            elif layout_flat[s] == -1:
-                self._p[s, :, self.trap_state] = 1.0
-            elif layout_flat[s] == 1:
-                self._p[s, :, self.goal_state] = 1.0
-            else:
-                neighbors = []
-                for a in range(4):
-                    c = np.unravel_index(s, self.layout.shape)
-
-                    next_c = c[0] + actions[a][0], c[1] + actions[a][1]
-                    next_s = np.ravel_multi_index(next_c, self.layout.shape, 'clip')
-
-                    self._p[s, a, next_s] = 1. - self.slip
-
-                    neighbors.append(next_s)
-
-                for neighbor in neighbors:
-                    self._p[s, :, neighbor] += self.slip / self.n_actions
+        moves = np.array([(-1, 0), (0, -1), (1, 0), (0, 1)])
+
+        cells = np.arange(self.layout.size)
+        rows, columns = np.unravel_index(cells, self.layout.shape)
+
+        # neighbors[s, a] is the cell reached from s by action a
+        next_rows = np.clip(rows[:, None] + moves[:, 0], 0, self.layout.shape[0] - 1)
+        next_columns = np.clip(columns[:, None] + moves[:, 1], 0, self.layout.shape[1] - 1)
+        neighbors = np.ravel_multi_index((next_rows, next_columns), self.layout.shape)
+
+        free = cells[layout_flat == 0]
+        n_free = len(free)
+        all_actions = np.arange(self.n_actions)
+
+        # Intended moves and slips towards each of the four neighbors
+        states = [np.repeat(free, self.n_actions), np.repeat(free, self.n_actions ** 2)]
+        actions = [np.tile(all_actions, n_free), np.tile(np.repeat(all_actions, self.n_actions), n_free)]
+        next_states = [neighbors[free].reshape(-1), np.repeat(neighbors[free], self.n_actions, axis=0).reshape(-1)]
+        probabilities = [np.full(n_free * self.n_actions, 1. - self.slip),
+                         np.full(n_free * self.n_actions ** 2, self.slip / self.n_actions)]
+
+        # Traps and goals lead to absorbing states
+        for sources, target in [(cells[layout_flat == -1], self.trap_state), (cells[layout_flat == 1], self.goal_state),
+                                ([self.trap_state], self.trap_state), ([self.goal_state], self.goal_state)]:
+            states.append(np.repeat(sources, self.n_actions))
+            actions.append(np.tile(all_actions, len(sources)))
+            next_states.append(np.full(len(sources) * self.n_actions, target))
+            probabilities.append(np.ones(len(sources) * self.n_actions))
+
+        self.compress_transitions(np.concatenate(states), np.concatenate(actions), np.concatenate(next_states),
+                                  np.concatenate(probabilities))
 
     def __call__(self, s, a, next_s):
-        return self._p[s, a, next_s]
+        next_states, probabilities = self.successors(s, a)
+        return np.sum(probabilities[next_states == next_s])
 
     def render(self, state, reward):
         if state == self.trap_state:
@@ -70,6 +77,9 @@ class FixedPolicy(Policy):
     def __getitem__(self, states):
         return self.actions[len(states) - 1]
 
+    def batch_actions(self, states):
+        return np.full(len(states), self.actions[states.shape[1] - 1])
+
 
 class InteractivePolicy(Policy):
     def __init__(self):
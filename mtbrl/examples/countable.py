@@ -27,10 +27,13 @@ def bandits_test():
     bb4.simulate(initial_distribution, reward, policy)
     print(f'## Fixed policy value: {bamdp.value(initial_distribution, policy, horizon=horizon)}')
 
-    optimal_policy = bamdp.solve(initial_distribution, horizon)
+    mean, standard_error = bamdp.monte_carlo_value(initial_distribution, policy, horizon, seed=0)
+    print(f'## Fixed policy Monte Carlo value: {mean} +/- {standard_error}')
+
+    optimal_policy = bamdp.solve(initial_distribution, horizon, transpositions=True)
     print('\n## Optimal policy simulation:')
     bb4.simulate(initial_distribution, reward, optimal_policy)
-    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon)}')
+    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon, transpositions=True)}')
 
 
 def corridors_test():
@@ -48,10 +51,10 @@ def corridors_test():
     gw1.simulate(initial_distribution, reward, policy)
     print(f'## Fixed policy value: {bamdp.value(initial_distribution, policy, horizon=horizon)}')
 
-    optimal_policy = bamdp.solve(initial_distribution, horizon)
+    optimal_policy = bamdp.solve(initial_distribution, horizon, transpositions=True)
     print('\n## Optimal policy simulation:')
     gw1.simulate(initial_distribution, reward, optimal_policy)
-    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon)}')
+    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon, transpositions=True)}')
 
 
 def gridworlds_test():
@@ -78,10 +81,10 @@ def gridworlds_test():
     gw2.simulate(initial_distribution, reward, policy)
     print(f'## Fixed policy value: {bamdp.value(initial_distribution, policy, horizon=horizon)}')
 
-    optimal_policy = bamdp.solve(initial_distribution, horizon)
+    optimal_policy = bamdp.solve(initial_distribution, horizon, transpositions=True)
     print('\n## Optimal policy simulation:')
     gw3.simulate(initial_distribution, reward, optimal_policy)
-    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon)}')
+    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon, transpositions=True)}')
 
 
 def main():
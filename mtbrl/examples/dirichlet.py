@@ -11,19 +11,20 @@ from mtbrl.algorithms.bamdp import DirichletBAMDP
 
 def alphas_from_models(models):
     alphas = np.full((models[0].n_states, models[0].n_actions, models[0].n_states), 1e-8)
+    p = [model.transition_tensor() for model in models]
 
     for state in range(models[0].n_states):
         for action in range(models[0].n_actions):
             all_equal = True
             for i in range(1, len(models)):
-                if not np.allclose(models[0]._p[state, action], models[i]._p[state, action]):
+                if not np.allclose(p[0][state, action], p[i][state, action]):
                     all_equal = False
 
             if all_equal:
-                alphas[state, action] += models[0]._p[state, action] * 1e8
+                alphas[state, action] += p[0][state, action] * 1e8
             else:
                 for i in range(len(models)):
-                    alphas[state, action] += models[i]._p[state, action] / len(models)
+                    alphas[state, action] += p[i][state, action] / len(models)
 
     return alphas
 
@@ -45,10 +46,10 @@ def bandits_test():
     bb1.simulate(initial_distribution, reward, policy)
     print(f'## Fixed policy value: {bamdp.value(initial_distribution, policy, horizon=horizon)}')
 
-    optimal_policy = bamdp.solve(initial_distribution, horizon)
+    optimal_policy = bamdp.solve(initial_distribution, horizon, transpositions=True)
     print('\n## Optimal policy simulation:')
     bb2.simulate(initial_distribution, reward, optimal_policy)
-    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon)}')
+    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon, transpositions=True)}')
 
 
 def corridors_test():
@@ -67,10 +68,10 @@ def corridors_test():
     gw1.simulate(initial_distribution, reward, policy)
     print(f'## Fixed policy value: {bamdp.value(initial_distribution, policy, horizon=horizon)}')
 
-    optimal_policy = bamdp.solve(initial_distribution, horizon)
+    optimal_policy = bamdp.solve(initial_distribution, horizon, transpositions=True)
     print('\n## Optimal policy simulation:')
     gw2.simulate(initial_distribution, reward, optimal_policy)
-    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon)}')
+    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon, transpositions=True)}')
 
 
 def gridworlds_test():
@@ -94,10 +95,10 @@ def gridworlds_test():
     gw1.simulate(initial_distribution, reward, policy)
     print(f'## Fixed policy value: {bamdp.value(initial_distribution, policy, horizon=horizon)}')
 
-    optimal_policy = bamdp.solve(initial_distribution, horizon)
+    optimal_policy = bamdp.solve(initial_distribution, horizon, transpositions=True)
     print('\n## Optimal policy simulation:')
     gw1.simulate(initial_distribution, reward, optimal_policy)
-    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon)}')
+    print(f'## Optimal policy value: {bamdp.value(initial_distribution, optimal_policy, horizon=horizon, transpositions=True)}')
 
 
 def main():